@@ -0,0 +1,168 @@
+## Usage:
+# python benchmark.py [--sizes 64,256,1024,2048] [--entities 0,1000,100000]
+#                     [--tile-ranges 16,1000] [--repeat 3] [--out FILE]
+# Builds synthetic maps and measures encode/decode throughput, peak memory
+# (tracemalloc) and encoded size for:
+#   map       - serialize(Map) / deserialize, plain and interned
+#   stream    - serialize_to / deserialize_from through a file
+#   legacy    - decoding layers stored the old way, one varint per tile
+#   entities  - the Entity codec on its own
+# Results are written as JSON so runs can be compared. No window is opened.
+
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tracemalloc
+from game_types import *
+
+def make_layer(size, tile_range, rng, empty=0.0):
+    rows = []
+    for _ in range(size):
+        # Runs of the same tile, roughly like real floors and walls
+        row = []
+        while len(row) < size:
+            tile = 0 if rng.random() < empty else rng.randrange(tile_range)
+            row += [tile] * rng.randint(1, 8)
+        rows.append(row[:size])
+    return TileLayer(DEFAULT_TILESET, rows)
+
+def make_map(size, entities, tile_range, seed=0):
+    rng = random.Random(seed)
+    layers = [
+        make_layer(size, tile_range, rng),
+        make_layer(size, tile_range, rng, empty=0.7),
+        make_layer(size, tile_range, rng, empty=0.95),
+    ]
+    res = Map(layers, set())
+    for i in range(entities):
+        res.entities.add(Entity("entity%d" % i, {
+            "x": rng.randrange(size), "y": rng.randrange(size), "kind": rng.choice(["tree", "rock", "npc"])
+        }, "picture", res))
+    return res
+
+def legacy_dump(layer):
+    # TileLayer.dump as it was before packed arrays: one untagged varint per tile
+    res = bytearray(b"I")
+    res += serialize(layer.width) + serialize(layer.height) + serialize(layer.tileset_name)
+    for row in layer:
+        for cell in row:
+            res += serialize(cell)[1:]
+    return bytes(res)
+
+def measure(fn, repeat):
+    """Best wall time of `repeat` runs, then peak traced memory of one more"""
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        res = fn()
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return res, best, peak
+
+def result(case, params, op, size, seconds, peak):
+    return dict(params, case=case, op=op, bytes=size, seconds=seconds,
+                mb_per_s=size / seconds / 1e6 if seconds else None, peak_bytes=peak)
+
+def bench_map(params, level, repeat):
+    res = []
+    for intern in (False, True):
+        case = "map_interned" if intern else "map"
+        data, t, peak = measure(lambda: serialize(level, intern=intern), repeat)
+        res.append(result(case, params, "encode", len(data), t, peak))
+        _, t, peak = measure(lambda: deserialize(memoryview(data), 0), repeat)
+        res.append(result(case, params, "decode", len(data), t, peak))
+    return res
+
+def bench_stream(params, level, repeat):
+    def encode():
+        f = io.BytesIO()
+        serialize_to(level, f)
+        return f
+
+    f, t, peak = measure(encode, repeat)
+    size = f.tell()
+    res = [result("stream", params, "encode", size, t, peak)]
+
+    def decode():
+        f.seek(0)
+        return deserialize_from(f)
+
+    _, t, peak = measure(decode, repeat)
+    res.append(result("stream", params, "decode", size, t, peak))
+    return res
+
+def bench_legacy(params, level, repeat):
+    data = serialize([Legacy(layer) for layer in level.layers])
+    _, t, peak = measure(lambda: deserialize(memoryview(data), 0), repeat)
+    return [result("legacy", params, "decode", len(data), t, peak)]
+
+def bench_entities(params, level, repeat):
+    entities = list(level.entities)
+    data, t, peak = measure(lambda: serialize(entities), repeat)
+    res = [result("entities", params, "encode", len(data), t, peak)]
+    _, t, peak = measure(lambda: deserialize(memoryview(data), 0), repeat)
+    res.append(result("entities", params, "decode", len(data), t, peak))
+    return res
+
+# Writes layers in the old format, under TileLayer's name so they load back as
+# TileLayers
+@UserSerializable("game_types::TileLayer")
+class Legacy():
+
+    def __init__(self, layer):
+        self.layer = layer
+
+    def dump(self):
+        return legacy_dump(self.layer)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Serializer benchmarks")
+    ints = lambda s: [int(i) for i in s.split(",")]
+    parser.add_argument("--sizes", type=ints, default=[64, 256, 1024, 2048], help="map sizes, in tiles per side")
+    parser.add_argument("--entities", type=ints, default=[0, 1000, 100000])
+    parser.add_argument("--tile-ranges", type=ints, default=[16, 1000], help="number of distinct tile ids")
+    parser.add_argument("--cases", default="map,stream,legacy,entities")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--out", default="bench_results.json")
+    args = parser.parse_args(argv)
+
+    cases = {
+        "map": bench_map, "stream": bench_stream,
+        "legacy": bench_legacy, "entities": bench_entities,
+    }
+    results = []
+    for size in args.sizes:
+        for tile_range in args.tile_ranges:
+            for entities in args.entities:
+                params = {"size": size, "tile_range": tile_range, "entities": entities}
+                level = make_map(size, entities, tile_range)
+                for case in args.cases.split(","):
+                    if case == "entities" and not entities:
+                        continue
+                    for r in cases[case](params, level, args.repeat):
+                        print("%-13s %-6s size %5d tiles<%-5d ents %6d  %10d bytes  %8.1f MB/s  %10.3f ms  peak %8.1f MB" % (
+                            r["case"], r["op"], size, tile_range, entities, r["bytes"],
+                            r["mb_per_s"] or 0, r["seconds"] * 1000, r["peak_bytes"] / 1e6))
+                        results.append(r)
+
+    with open(args.out, "w") as f:
+        json.dump({
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "results": results,
+        }, f, indent=1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -17,15 +17,20 @@
 
 # import pygame
 import tkinter as tk
+import concurrent.futures
 from game_types import *
 import guipygame as gui
 from tkinter import messagebox
 
 TILESET_WIDTH = 256
+VIEW_SIZE = 800, 600
 CAMSPEED = 256
 SCROLLSPEED = 100
 DEFAULT_TILESET = ("blue.png", "blue")
 
+# Keep tiles in NumPy arrays when it's available
+TileLayer.storage = "numpy"
+
 # TODO: Refactor partial_update_selection and update_selections
 # TODO: Improve performance
 
@@ -47,6 +52,11 @@ class Editor():
         self.level = None
         self.layers = None
         self.current_map = None
+        self.journal = None
+        # Full saves run on this thread, see save()
+        self.saver = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.pending_save = None
+        self.save_error = None
         self.tileset_name = DEFAULT_TILESET
 
         self.tileset_scrollval = 0
@@ -65,7 +75,7 @@ class Editor():
 
         # Set up gui
         
-        self.ctx = gui.PygameContext(800 + TILESET_WIDTH + 2, 600)
+        self.ctx = gui.PygameContext(VIEW_SIZE[0] + TILESET_WIDTH + 2, VIEW_SIZE[1])
 
         self.toplevel_table = None
         self.toplevel = gui.PlaceLayout(None)
@@ -77,7 +87,7 @@ class Editor():
         self.tileset_img_layout = None
 
         self.tilemap_img_layout = gui.PlaceLayout(self.toplevel_table,
-                                                  minsize=gui.Vector2(800, 600), maxsize=gui.Vector2(800, 600))
+                                                  minsize=gui.Vector2(*VIEW_SIZE), maxsize=gui.Vector2(*VIEW_SIZE))
         self.tilemap_img_container = self.ctx.empty_image(0, 0)
         self.tilemap_img_widget = gui.ImageWidget(self.tilemap_img_layout,
                                                   image=self.tilemap_img_container)
@@ -107,13 +117,26 @@ class Editor():
 
     def change_level(self, to):
         if to >= 0:
+            if self.journal is not None:
+                # Fold the saved edits of the level we're leaving into its file
+                self.wait_for_save()
+                LevelJournal.compact_file(self.journal.filename)
+
             self.level = to
             try:
                 with open(f"level{self.level}", "rb") as f:
-                    self.current_map = deserialize(f.read(), 0)[0]
+                    self.current_map = deserialize_from(f)
                     self.layers = self.current_map.layers
                     for layer in self.layers:
                         layer.set_ctx(self.ctx)
+                # Tilesets are only loaded when first drawn; load them now so a
+                # missing or broken one is reported like a bad map file instead
+                # of failing in the middle of drawing
+                try:
+                    for layer in self.layers:
+                        layer.tileset
+                except (OSError, RuntimeError) as e:
+                    raise ValueError("can't load tileset: %s" % e)
                 
             except FileNotFoundError:
                 self.load_default_map()
@@ -122,20 +145,26 @@ class Editor():
                 self.display_error("Invalid map file", e)
                 self.load_default_map()
 
+            self.journal = LevelJournal(f"level{self.level}", self.current_map)
+            if self.journal.replay():
+                print("level%d: recovered edits from the journal" % self.level)
+
             if self.toplevel_table is not None:
                 self.reload_tileset_image()
 
             self.reload_tilemap_image()
 
     def reload_tilemap_image(self):
-        self.tilemap_img_container = self.ctx.empty_image(
-            len(self.layers[0][0]) * TILESIZE[0],
-            len(self.layers[0]) * TILESIZE[1]
-        )
-        self.tilemap_img_widget.attrs["image"] = self.tilemap_img_container
-        self.ctx.fill_image(self.tilemap_img_container, [0xC0, 0xC0, 0xC0])
-        for layer in self.layers:
-            layer.draw(self.tilemap_img_container, (0, 0))
+        # Only the part of the map under the camera is drawn, onto an image
+        # the size of the view
+        if (self.tilemap_img_container.w, self.tilemap_img_container.h) != VIEW_SIZE:
+            self.tilemap_img_container = self.ctx.empty_image(*VIEW_SIZE)
+            self.tilemap_img_widget.attrs["image"] = self.tilemap_img_container
+        map_size = self.layers[0].width * TILESIZE[0], self.layers[0].height * TILESIZE[1]
+        self.ctx.fill_image(self.tilemap_img_container, [0, 0, 0, 0])
+        self.ctx.fill_image(self.tilemap_img_container, [0xC0, 0xC0, 0xC0], ((-self.camx, -self.camy), map_size))
+        self.current_map.draw_background(self.tilemap_img_container, (-self.camx, -self.camy))
+        self.current_map.draw_overlay(self.tilemap_img_container, (-self.camx, -self.camy))
 
     def load_default_map(self):
         self.layers = [
@@ -146,10 +175,8 @@ class Editor():
         self.current_map = Map(self.layers, set())
         
         for layer in self.layers:
-            self.add_rows(layer._layer, 16)
-            self.add_columns(layer._layer, 16)
+            layer.resize(16, 16)
             layer.set_ctx(self.ctx)
-            layer._regen_surface()
 
     def reload_tileset_image(self):
         self.tileset_image = self.ctx.empty_image(self.layers[0].tileset.img.w, self.layers[0].tileset.img.h)
@@ -215,28 +242,11 @@ class Editor():
                 print(str(e))
                 b = False
                 break
-            layer._surface = None
         if b:
             self.tileset_name = new_tileset_name
             self.reload_tileset_image()
             self.reload_tilemap_image()
 
-    def add_rows(self, table, n):
-        table += [[] for _ in range(n)]
-
-    def add_columns(self, table, n):
-        for i in table:
-            i += [0 for _ in range(n)]
-
-    def remove_rows(self, table, n):
-        for _ in range(n):
-            table.pop()
-
-    def remove_columns(self, table, n):
-        for row in table:
-            for _ in range(n):
-                row.pop()        
-
     def tileset_scroll_up(self, w, e):
         self.tileset_scrollval -= SCROLLSPEED
 
@@ -278,35 +288,46 @@ class Editor():
             self.current_layer = 2
 
         elif e.value == b"s"[0]:
-            self.save_time = time.perf_counter()
-            # TileLayer.save_layers(f"level{self.level}", self.layers)
-            with open(f"level{self.level}", "wb") as f:
-                f.write(serialize(self.current_map))
+            self.save()
 
         else:
             return gui.CallNextEventHandler
 
+    def save(self):
+        # Edits are appended to the level's journal, which is quick. When the
+        # whole level has to be written, that happens on the saver thread from
+        # a snapshot, so editing can go on meanwhile.
+        if self.journal.needs_compaction():
+            # Saves have to finish in order
+            self.wait_for_save()
+        future = self.journal.save(self.saver.submit)
+        if future is None:
+            self.save_time = time.perf_counter()
+            return
+        self.pending_save = future
+        self.pending_save.add_done_callback(self.on_saved)
+
+    def on_saved(self, future):
+        # Called on the saver thread
+        if future.exception() is not None:
+            self.save_error = future.exception()
+        else:
+            self.save_time = time.perf_counter()
+
+    def wait_for_save(self):
+        if self.pending_save is not None:
+            concurrent.futures.wait([self.pending_save])
+            self.pending_save = None
+
     def set_width_cb(self, text):
         width = int(text)
         for layer in self.layers:
-            if len(layer[0]) < width:
-                self.add_columns(layer._layer, width - len(layer[0]))
-                
-            elif len(layer[0]) > width:
-                self.remove_columns(layer._layer, len(layer[0]) - width)
-                layer._regen_surface()
+            layer.resize(width, layer.height)
 
     def set_height_cb(self, text):
         height = int(text)
         for layer in self.layers:
-            if len(layer) < height:
-                difference = height - len(layer)
-                self.add_rows(layer._layer, difference)
-                self.add_columns(layer[-difference:], len(layer[0]))
-            
-            elif len(layer) > height:
-                self.remove_rows(layer._layer, len(layer) - height)
-                layer._regen_surface()
+            layer.resize(layer.width, height)
 
     def handle_keyheld(self, w, e):
         dt = self.ctx.get_frametime()
@@ -320,10 +341,10 @@ class Editor():
         elif e.value == gui.SpecialKeys.RARR:
             self.camx_f += CAMSPEED * dt
 
-        cid = self.tilemap_img_layout.getChildID(self.tilemap_img_widget)
-        self.camx = int(self.camx_f)
-        self.camy = int(self.camy_f)
-        self.tilemap_img_layout.children[cid][1]["pos"] = Vector2(-self.camx, -self.camy)
+        if (int(self.camx_f), int(self.camy_f)) != (self.camx, self.camy):
+            self.camx = int(self.camx_f)
+            self.camy = int(self.camy_f)
+            self.reload_tilemap_image()
 
     def on_tileset_left_clicked(self, widget, e):
         self.tileset_left_pressed = True
@@ -365,16 +386,11 @@ class Editor():
 
     def fill_tilemap_area(self):
         ts_w = self.layers[0].tileset.img.w // TILESIZE[0]
-        for x in range(self.selection_tilemap[0], self.selection_tilemap[0] + self.selection_tilemap[2]):
-            for y in range(self.selection_tilemap[1], self.selection_tilemap[1] + self.selection_tilemap[3]):
-                tsx = (x - self.selection_tilemap[0]) % self.selection_tileset[2] + self.selection_tileset[0]
-                tsy = (y - self.selection_tilemap[1]) % self.selection_tileset[3] + self.selection_tileset[1]
-                try:
-                    self.layers[self.current_layer][y][x] = ts_w * tsy + tsx
-                except IndexError:
-                    pass
+        tsx, tsy, tsw, tsh = self.selection_tileset
+        pattern = [[ts_w * (tsy + y) + tsx + x for x in range(tsw)] for y in range(tsh)]
+        x, y, w, h = self.selection_tilemap
+        self.layers[self.current_layer].stamp(x, y, pattern, w, h)
         
-        self.layers[self.current_layer]._regen_surface()
         self.reload_tilemap_image()
     
     def run(self):
@@ -400,8 +416,14 @@ class Editor():
             i.bind(gui.EventType.LEFTRELEASE, self.on_tileset_left_released)
         
         self.ctx.set_interval(self.update, 1/30)
+        self.ctx.set_interval(self.check_tilesets, 1)
         self.ctx.mainloop(self.toplevel)
 
+        # Only what was saved goes into the level file
+        self.wait_for_save()
+        self.saver.shutdown()
+        LevelJournal.compact_file(self.journal.filename)
+
     def tile_box_logic(self, old_pos, new_pos, selection):
         if new_pos.x > old_pos.x:
             selection[2] = max((new_pos.x - old_pos.x) // TILESIZE[0], 1)
@@ -415,8 +437,22 @@ class Editor():
             selection[1] = (new_pos.y + self.camy) // TILESIZE[1]
             selection[3] = max((old_pos.y - new_pos.y) // TILESIZE[1], 1)
         
+    def check_tilesets(self):
+        # Pick up tilesets re-exported while the editor is open; the layers
+        # using them are already invalidated
+        if tileset_cache.check_for_changes():
+            self.reload_tileset_image()
+            self.reload_tilemap_image()
+
     def update(self):
-        width, height = len(self.layers[0][0]), len(self.layers[0])
+        if self.save_error is not None:
+            error, self.save_error = self.save_error, None
+            self.display_error("Saving failed", str(error))
+
+        if self.current_map.animate(time.perf_counter()):
+            self.reload_tilemap_image()
+
+        width, height = self.layers[0].width, self.layers[0].height
         save_message = "Saved!" if time.perf_counter() - self.save_time < 0.4 else ""
         self.ctx.title("Width %d, height %d, current layer %d | %.2f FPS | Editing level%d | %s" % (
             width, height, self.current_layer + 1, self.ctx.get_fps(), self.level, save_message
@@ -3,19 +3,45 @@
 # Requires the Pygame module
 
 TILESIZE = 32, 32
+CHUNK_SIZE = 32     # In tiles, for chunked level files
+SURFACE_CHUNK_SIZE = 16             # In tiles, for rendered layer surfaces
+SURFACE_CACHE_BUDGET = 256 << 20    # In bytes of pixel data
+TILESET_CACHE_BUDGET = 64 << 20     # Likewise, for tilesets no layer uses
 TILESET_DIR = "."
 DEFAULT_TILESET = "blue"
 
 import os
+import lzma
+import mmap
+import zlib
+import array
+import warnings
 import gui as _gui
 import time
 import struct
+import weakref
+import itertools
+import collections
 # import pygame
 
 import scripts
 from guipygame import *
 from serializer import *
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# (compress, decompress) for TileLayer.compression
+LAYER_COMPRESSORS = {
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress)
+}
+
+
+def _rects_overlap(a, b):
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
 
 class StopGame(RuntimeError):
     pass
@@ -23,18 +49,34 @@ class StopGame(RuntimeError):
 class Tileset():
 
     """
->>> # Tileset container class. Caches tilesets with the same name:
+>>> # Tileset container class. Caches tilesets loaded from the same file
+>>> # (see tileset_cache), and reloads them if the file changed:
 >>> x = Tileset("blue.png", "blue")
 >>> y = Tileset("./blue.png", "blue")
 >>> x is y
 True
 """
 
-    cache = {}
+    # What's in each tile, see kinds
+    EMPTY = 0       # Fully transparent, never drawn
+    OPAQUE = 1      # No transparency, drawn without alpha blending
+    MIXED = 2
+
+    # Atlas mode keeps the tileset as the one image it was loaded from and
+    # draws tiles from rectangles of it (see source()); otherwise the image is
+    # cut up into one image per tile up front
+    atlas = True
+
+    # Animations are read from a file next to the image, named like it but
+    # ending in ANIMATION_SUFFIX. Each line is "tile period frame frame ...":
+    # the tile cycles through the frames (tile ids), showing each for
+    # `period` seconds. Empty lines and ones starting with # are skipped.
+    ANIMATION_SUFFIX = ".anim"
 
     def __new__(cls, ctx, filename, name):
-        if name in cls.cache:
-            return cls.cache[name]
+        cached = tileset_cache.lookup(filename)
+        if cached is not None:
+            return cached
         return super(Tileset, cls).__new__(Tileset)
     
     def __init__(self, ctx, filename, name):
@@ -44,109 +86,1152 @@ True
         self.ctx = ctx
 
         self.name = name
-        img = self.ctx.load_image(filename)
+        self.path = os.path.realpath(filename)
+        # Layers drawing with the tileset; it's pinned in the cache while
+        # there are any (or while pin() was called more often than unpin())
+        self._users = weakref.WeakSet()
+        self._pins = 0
+        self._load()
 
+        tileset_cache.add(self)
+
+    def _load(self):
+        self.mtime = _mtime(self.path)
+        img = self.ctx.load_image(self.path)
+
+        self.columns = img.w // TILESIZE[0]
+        self.count = self.columns * (img.h // TILESIZE[1])
         self.tiles = []
-        for y in range(img.h // TILESIZE[1]):
-            row = []
-            for x in range(img.w // TILESIZE[0]):
-                row.append(ctx.empty_image(*TILESIZE))
-                ctx.blit(row[-1], img, (0, 0), (x * TILESIZE[0], y * TILESIZE[1], TILESIZE[0], TILESIZE[1]))
-            self.tiles += row
+        if not self.atlas:
+            for i in range(self.count):
+                self.tiles.append(self._cut_tile(img, i))
 
         self.img = img
 
-        Tileset.cache[name] = self
+        self.kinds = [self._tile_kind(i) for i in range(self.count)]
+        # Opaque tiles are drawn from a copy of the image without alpha,
+        # unless all of them are (then the image has none to begin with)
+        self.opaque_img = None
+        if self.OPAQUE in self.kinds and any(kind != self.OPAQUE for kind in self.kinds):
+            self.opaque_img = self.ctx.empty_image(img.w, img.h, alpha=False)
+            self.ctx.blit(self.opaque_img, img, (0, 0))
+
+        # tile -> (frames, period)
+        self.animations = {}
+        anim_path = os.path.splitext(self.path)[0] + self.ANIMATION_SUFFIX
+        if os.path.exists(anim_path):
+            with open(anim_path) as f:
+                for lineno, line in enumerate(f, 1):
+                    line = line.strip()
+                    if not line or line.startswith("#"):
+                        continue
+                    try:
+                        tile, period, *frames = line.split()
+                        self.add_animation(int(tile), [int(i) for i in frames], float(period))
+                    except (ValueError, IndexError) as e:
+                        raise ValueError("%s:%d: %s" % (anim_path, lineno, e))
+
+    def _tile_kind(self, i):
+        coverage = self.ctx.alpha_coverage(self.img, self.rect(i))
+        if coverage is None:
+            return self.MIXED
+        visible, opaque = coverage
+        if visible == 0:
+            return self.EMPTY
+        if opaque == TILESIZE[0] * TILESIZE[1]:
+            return self.OPAQUE
+        return self.MIXED
+
+    def reload(self):
+        """Loads the image again and makes every layer using the tileset
+redraw itself"""
+        self._load()
+        for layer in list(self._users):
+            layer.invalidate()
+
+    def add_animation(self, tile, frames, period):
+        """Makes `tile` cycle through `frames` (tile ids), showing each for
+`period` seconds"""
+        if not frames:
+            raise ValueError("animation of tile %d has no frames" % tile)
+        if period <= 0:
+            raise ValueError("animation of tile %d has a period of %r" % (tile, period))
+        for i in [tile] + list(frames):
+            self.rect(i)
+        self.animations[tile] = list(frames), period
+        for layer in list(self._users):
+            layer.invalidate()
+
+    def remove_animation(self, tile):
+        if self.animations.pop(tile, None) is not None:
+            for layer in list(self._users):
+                layer.invalidate()
+
+    def frame_index(self, tile, t):
+        """Which frame of the animation of `tile` is shown at `t` seconds"""
+        frames, period = self.animations[tile]
+        return int(t // period) % len(frames)
+
+    def frame(self, tile, t):
+        """The tile shown in place of `tile` at `t` seconds"""
+        animation = self.animations.get(tile)
+        if animation is None:
+            return tile
+        frames, period = animation
+        return frames[int(t // period) % len(frames)]
+
+    def add_user(self, layer):
+        self._users.add(layer)
+
+    def remove_user(self, layer):
+        self._users.discard(layer)
+
+    def pin(self):
+        self._pins += 1
+
+    def unpin(self):
+        self._pins -= 1
+
+    @property
+    def pinned(self):
+        return self._pins > 0 or len(self._users) > 0
+
+    @property
+    def size(self):
+        """Bytes of pixel data held by the tileset"""
+        size = self.img.w * self.img.h * 4
+        copies = 1 + bool(self.tiles) + (self.opaque_img is not None)
+        return size * copies
+
+    def _cut_tile(self, img, i):
+        tile = self.ctx.empty_image(*TILESIZE)
+        self.ctx.blit(tile, img, (0, 0), self.rect(i))
+        return tile
+
+    def rect(self, i):
+        """(x, y, w, h) of tile i in the tileset image"""
+        if not 0 <= i < self.count:
+            raise IndexError("tile %d out of range" % i)
+        return i % self.columns * TILESIZE[0], i // self.columns * TILESIZE[1], TILESIZE[0], TILESIZE[1]
+
+    def source(self, i):
+        """Returns (image, bbox) to blit tile i from, or None for empty tiles"""
+        rect = self.rect(i)
+        kind = self.kinds[i]
+        if kind == self.EMPTY:
+            return None
+        if kind == self.OPAQUE and self.opaque_img is not None:
+            return self.opaque_img, rect
+        if self.tiles:
+            return self.tiles[i], None
+        return self.img, rect
 
     def __iter__(self):
-        return iter(self.tiles)
+        return (self[i] for i in range(self.count))
 
     def __getitem__(self, x):
+        if not self.tiles:
+            # Atlas mode, cut up the image after all
+            self.tiles = [self._cut_tile(self.img, i) for i in range(self.count)]
         return self.tiles[x]
 
+def load_tileset(name, ctx=None):
+    """Loads the tileset called `name` from TILESET_DIR"""
+    if ctx is None:
+        ctx = _gui.Context.current_ctx
+    return Tileset(ctx, os.path.join(TILESET_DIR, name + ".png"), name)
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+class TilesetCache():
+
+    """Tilesets by resolved file path, least recently used first. Tilesets
+whose file changed are reloaded when they're next looked up (or by
+check_for_changes). Once they take up more than `budget` bytes, the least
+recently used ones that aren't pinned are dropped."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self._tilesets = collections.OrderedDict()
+
+    @property
+    def size(self):
+        return sum(tileset.size for tileset in self._tilesets.values())
+
+    def lookup(self, filename):
+        path = os.path.realpath(filename)
+        tileset = self._tilesets.get(path)
+        if tileset is None:
+            return None
+        self._tilesets.move_to_end(path)
+        mtime = _mtime(path)
+        if mtime is not None and mtime != tileset.mtime:
+            tileset.reload()
+            self.trim()
+        return tileset
+
+    def add(self, tileset):
+        self._tilesets[tileset.path] = tileset
+        self._tilesets.move_to_end(tileset.path)
+        self.trim()
+
+    def check_for_changes(self):
+        """Reloads every cached tileset whose file changed, and returns them"""
+        res = []
+        for tileset in list(self._tilesets.values()):
+            mtime = _mtime(tileset.path)
+            if mtime is not None and mtime != tileset.mtime:
+                tileset.reload()
+                res.append(tileset)
+        if res:
+            self.trim()
+        return res
+
+    def set_budget(self, budget):
+        self.budget = budget
+        self.trim()
+
+    def trim(self):
+        # The most recently used tileset always stays
+        size = self.size
+        for path, tileset in list(self._tilesets.items())[:-1]:
+            if size <= self.budget:
+                break
+            if not tileset.pinned:
+                del self._tilesets[path]
+                size -= tileset.size
+
+    def clear(self):
+        self._tilesets.clear()
+
+tileset_cache = TilesetCache(TILESET_CACHE_BUDGET)
+
+class SurfaceCache():
+
+    """LRU cache of rendered surfaces, shared by every TileLayer. Keys are
+(owner, ...) tuples; once the images in it take up more than `budget` bytes
+the least recently used ones are dropped."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self._images = collections.OrderedDict()
+        self._owners = {}
+
+    def get(self, key):
+        image = self._images.get(key)
+        if image is not None:
+            self._images.move_to_end(key)
+        return image
+
+    def peek(self, key):
+        """Like get(), but doesn't count as a use"""
+        return self._images.get(key)
+
+    def put(self, key, image):
+        self.discard(key)
+        self._images[key] = image
+        self._owners.setdefault(key[0], set()).add(key)
+        self.size += self._image_size(image)
+        self.trim()
+
+    def discard(self, key):
+        image = self._images.pop(key, None)
+        if image is not None:
+            self.size -= self._image_size(image)
+            keys = self._owners[key[0]]
+            keys.discard(key)
+            if not keys:
+                del self._owners[key[0]]
+
+    def discard_owner(self, owner):
+        for key in list(self._owners.get(owner, ())):
+            self.discard(key)
+
+    def set_budget(self, budget):
+        self.budget = budget
+        self.trim()
+
+    def trim(self):
+        # The newest image always stays, even if it's over budget by itself
+        while self.size > self.budget and len(self._images) > 1:
+            self.discard(next(iter(self._images)))
+
+    def clear(self):
+        self._images.clear()
+        self._owners.clear()
+        self.size = 0
+
+    @staticmethod
+    def _image_size(image):
+        return image.w * image.h * 4
+
+surface_cache = SurfaceCache(SURFACE_CACHE_BUDGET)
+
+CHUNK_PIXELS = SURFACE_CHUNK_SIZE * TILESIZE[0], SURFACE_CHUNK_SIZE * TILESIZE[1]
+_chunk_versions = itertools.count()
+
+def _chunks_in_view(view, width, height):
+    # (cx0, cy0, cx1, cy1) range of the chunks of a width x height tiles big
+    # layer that overlap `view`
+    return (max(view[0] // CHUNK_PIXELS[0], 0),
+            max(view[1] // CHUNK_PIXELS[1], 0),
+            min(-(-(view[0] + view[2]) // CHUNK_PIXELS[0]), -(-width // SURFACE_CHUNK_SIZE)),
+            min(-(-(view[1] + view[3]) // CHUNK_PIXELS[1]), -(-height // SURFACE_CHUNK_SIZE)))
+
+class SparseGrid():
+
+    """Tiles of a mostly empty layer: only the ones that aren't 0 are kept, in
+one dict per SURFACE_CHUNK_SIZE big chunk that maps (x, y) to the tile.
+grid[y] is a row that can be indexed like a list."""
+
+    def __init__(self, width, height, cells=()):
+        self.width = width
+        self.height = height
+        # (cx, cy) -> {(x, y): tile}, chunks without tiles are left out
+        self.chunks = {}
+        self.count = 0
+        for x, y, tile in cells:
+            self.set(x, y, tile)
+
+    @classmethod
+    def from_rows(cls, rows):
+        if numpy is not None and isinstance(rows, numpy.ndarray):
+            ys, xs = numpy.nonzero(rows)
+            return cls(rows.shape[1], rows.shape[0], zip(xs.tolist(), ys.tolist(), rows[ys, xs].tolist()))
+        grid = cls(len(rows[0]) if len(rows) else 0, len(rows))
+        for y, row in enumerate(rows):
+            for x, tile in enumerate(row):
+                if tile:
+                    grid.set(x, y, tile)
+        return grid
+
+    def copy(self):
+        res = SparseGrid(self.width, self.height)
+        res.chunks = {key: dict(chunk) for key, chunk in self.chunks.items()}
+        res.count = self.count
+        return res
+
+    def get(self, x, y):
+        chunk = self.chunks.get((x // SURFACE_CHUNK_SIZE, y // SURFACE_CHUNK_SIZE))
+        if chunk is None:
+            return 0
+        return chunk.get((x, y), 0)
+
+    def set(self, x, y, tile):
+        key = x // SURFACE_CHUNK_SIZE, y // SURFACE_CHUNK_SIZE
+        chunk = self.chunks.get(key)
+        if tile:
+            if chunk is None:
+                chunk = self.chunks[key] = {}
+            if (x, y) not in chunk:
+                self.count += 1
+            chunk[x, y] = tile
+        elif chunk is not None and (x, y) in chunk:
+            del chunk[x, y]
+            self.count -= 1
+            if not chunk:
+                del self.chunks[key]
+
+    def cells(self):
+        """(x, y, tile) of every tile that isn't 0, chunk by chunk"""
+        for chunk in self.chunks.values():
+            for (x, y), tile in chunk.items():
+                yield x, y, tile
+
+    def rows(self, x0, y0, x1, y1):
+        """The tiles of a rectangle, as lists of ints"""
+        x1, y1 = min(x1, self.width), min(y1, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return []
+        res = [[0] * (x1 - x0) for _ in range(y1 - y0)]
+        for cy in range(y0 // SURFACE_CHUNK_SIZE, (y1 - 1) // SURFACE_CHUNK_SIZE + 1):
+            for cx in range(x0 // SURFACE_CHUNK_SIZE, (x1 - 1) // SURFACE_CHUNK_SIZE + 1):
+                for (x, y), tile in self.chunks.get((cx, cy), {}).items():
+                    if x0 <= x < x1 and y0 <= y < y1:
+                        res[y - y0][x - x0] = tile
+        return res
+
+    def resize(self, width, height):
+        """Crops or extends the grid, new cells are 0"""
+        if width < self.width or height < self.height:
+            for x, y, tile in list(self.cells()):
+                if x >= width or y >= height:
+                    self.set(x, y, 0)
+        self.width, self.height = width, height
+
+    def __eq__(self, other):
+        if not isinstance(other, SparseGrid):
+            return NotImplemented
+        return (self.width, self.height, self.chunks) == (other.width, other.height, other.chunks)
+
+    def __len__(self):
+        return self.height
+
+    def __iter__(self):
+        for y in range(self.height):
+            yield self.rows(0, y, self.width, y + 1)[0]
+
+    def __getitem__(self, y):
+        if isinstance(y, slice):
+            return [self[i] for i in range(*y.indices(self.height))]
+        if y < 0:
+            y += self.height
+        if not 0 <= y < self.height:
+            raise IndexError("row index out of range")
+        return _SparseRow(self, y)
+
+    def __setitem__(self, y, row):
+        self[y][:] = row
+
+class _RowView():
+
+    # Base of the rows handed out for storage that isn't a list of rows, so
+    # they compare and print like the lists callers expect
+
+    __hash__ = None
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, _RowView)):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+class _SparseRow(_RowView):
+
+    # A row of a SparseGrid
+
+    def __init__(self, grid, y):
+        self.grid = grid
+        self.y = y
+
+    def __len__(self):
+        return self.grid.width
+
+    def __iter__(self):
+        return iter(self.grid.rows(0, self.y, self.grid.width, self.y + 1)[0])
+
+    def __getitem__(self, x):
+        if isinstance(x, slice):
+            return list(self)[x]
+        return self.grid.get(self._index(x), self.y)
+
+    def __setitem__(self, x, tile):
+        if isinstance(x, slice):
+            xs = range(*x.indices(self.grid.width))
+            tiles = list(tile)
+            if len(tiles) != len(xs):
+                raise ValueError("can't change the length of a row of a sparse layer")
+            for i, tile in zip(xs, tiles):
+                self.grid.set(i, self.y, tile)
+            return
+        self.grid.set(self._index(x), self.y, tile)
+
+    def _index(self, x):
+        if x < 0:
+            x += self.grid.width
+        if not 0 <= x < self.grid.width:
+            raise IndexError("row index out of range")
+        return x
+
+class _ArrayRow(_RowView):
+
+    # A row of a layer kept in a NumPy array; tiles are read as ints, like
+    # from a list
+
+    def __init__(self, array, y):
+        self.array = array
+        self.y = y
+
+    def __len__(self):
+        return self.array.shape[1]
+
+    def __iter__(self):
+        return iter(self.array[self.y].tolist())
+
+    def __getitem__(self, x):
+        if isinstance(x, slice):
+            return self.array[self.y, x].tolist()
+        return int(self.array[self.y, x])
+
+    def __setitem__(self, x, tile):
+        self.array[self.y, x] = tile
+
 # @Serializable("game_types::TileLayer", exclude=["tileset", "_surface"])
 @UserSerializable("game_types::TileLayer")
 class TileLayer():
 
     # __slots__ = ["_layer", "tileset", "_surface", "tileset_name"]
 
+    # Name of one of LAYER_COMPRESSORS to write compressed layers, None
+    # writes them uncompressed. Either kind can always be loaded.
+    compression = None
+
+    # Bulk edits of more cells than this aren't tracked cell by cell: the
+    # chunks they touch are re-rendered, and the next save writes the whole
+    # level (see LevelJournal)
+    BULK_CELLS = 4096
+
+    # How tiles are stored: "list" keeps a list of rows of ints, "numpy" a
+    # 2-D uint16 array (a fraction of the memory, and the bulk edits below
+    # are vectorized). Layers fall back to lists if NumPy isn't installed or
+    # a tile id doesn't fit in 16 bits. Indexing and iterating over a layer
+    # gives rows of ints whatever the storage.
+    storage = "list"
+
+    # Layers with at most this fraction of tiles that aren't 0 are kept in a
+    # SparseGrid, whatever `storage` says; there iterating over the tiles,
+    # dump() and rendering only touch those. They go back to dense storage
+    # once they're filled up to twice that. None turns sparse layers off.
+    sparse_density = 0.05
+
     def __init__(self, tileset, layerdata):
-        self._layer = layerdata
-        self.tileset = tileset
-        self.tileset_name = tileset.name
-        self._surface = None
+        # `tileset` can also be just the name of one, in which case it's only
+        # loaded when it's first needed for drawing. That keeps loading and
+        # saving levels possible without a Context (see leveltool.py).
+        self._layer = self._make_grid(layerdata)
+        self._init_surfaces()
+        if isinstance(tileset, str):
+            self._tileset = None
+            self.tileset_name = tileset
+        else:
+            self.tileset = tileset
+        # Cells changed through set_cell since the last take_changes()
+        self._changed = set()
+        # Set by bulk edits too big to keep track of cell by cell
+        self._rewritten = False
         self.ctx = _gui.Context.current_ctx
 
+    @classmethod
+    def _make_grid(cls, rows):
+        # Turns rows of tiles (lists, an array or a SparseGrid) into whatever
+        # `storage` and sparse_density ask for
+        if isinstance(rows, SparseGrid):
+            if cls.sparse_density is None:
+                return cls._make_dense(rows.rows(0, 0, rows.width, rows.height))
+            return rows
+        if cls._should_be_sparse(rows):
+            return SparseGrid.from_rows(rows)
+        return cls._make_dense(rows)
+
+    @classmethod
+    def _should_be_sparse(cls, rows):
+        if cls.sparse_density is None or not len(rows):
+            return False
+        if numpy is not None and isinstance(rows, numpy.ndarray):
+            return numpy.count_nonzero(rows) <= cls.sparse_density * rows.size
+        width = len(rows[0])
+        if any(len(row) != width for row in rows):
+            return False
+        cells = width * len(rows)
+        return cells - sum(row.count(0) for row in rows) <= cls.sparse_density * cells
+
+    @classmethod
+    def _make_dense(cls, rows):
+        if cls.storage == "numpy" and numpy is not None:
+            try:
+                grid = numpy.array(rows, numpy.int64) if len(rows) else numpy.zeros((0, 0), numpy.int64)
+            except (ValueError, OverflowError):
+                # Rows of different lengths, or huge tile ids
+                grid = None
+            if grid is not None and grid.ndim == 2 and (grid.size == 0 or (grid.min() >= 0 and grid.max() <= 0xffff)):
+                return grid.astype(numpy.uint16)
+        if numpy is not None and isinstance(rows, numpy.ndarray):
+            return rows.tolist()
+        return rows
+
+    def _is_array(self):
+        return numpy is not None and isinstance(self._layer, numpy.ndarray)
+
+    def _is_sparse(self):
+        return isinstance(self._layer, SparseGrid)
+
+    def _check_storage(self, recount=False):
+        # Moves a sparse layer that filled up to dense storage. Going the other
+        # way takes counting the tiles, so that's only done with `recount`
+        # (after edits that went over the whole layer anyway).
+        if self._is_sparse():
+            if self.sparse_density is None or self._layer.count > 2 * self.sparse_density * self.width * self.height:
+                self._layer = self._make_dense(self._layer.rows(0, 0, self.width, self.height))
+        elif recount and self._should_be_sparse(self._layer):
+            self._layer = SparseGrid.from_rows(self._layer)
+
+    def _init_surfaces(self):
+        # The layer is drawn from SURFACE_CHUNK_SIZE tiles big chunks, which
+        # are rendered when first drawn and kept in surface_cache under
+        # (_surface_key, cx, cy)
+        self._surface_key = object()
+        self._rendered_size = None
+        # Bumped every time a chunk is drawn on, see chunk()
+        self._chunk_versions = {}
+        # (cx, cy) -> (version, whether the chunk is opaque), see
+        # chunk_is_opaque()
+        self._opaque_chunks = {}
+        # Cells that have to be redrawn on their chunk before it's next used
+        self._dirty = set()
+        # Time animated tiles are shown at, see animate()
+        self._anim_time = 0.0
+        # tile -> {(cx, cy): cells of the chunk with that animated tile}. Built
+        # when first needed, and thrown away by edits too big to update it
+        # cell by cell.
+        self._animated = None
+
     def set_ctx(self, ctx):
         self.ctx = ctx
 
+    @property
+    def tileset(self):
+        if self._tileset is None:
+            self._tileset = load_tileset(self.tileset_name, self.ctx)
+            self._tileset.add_user(self)
+        return self._tileset
+
+    @tileset.setter
+    def tileset(self, tileset):
+        if getattr(self, "_tileset", None) is not None:
+            self._tileset.remove_user(self)
+        self._tileset = tileset
+        self.tileset_name = tileset.name
+        tileset.add_user(self)
+        self.invalidate()
+
     def __init_deserialize__(self):
         self.ctx = _gui.Context.current_ctx
-        self.tileset  = Tileset(self.ctx, os.path.join(TILESET_DIR, self.tileset_name + ".png"), self.tileset_name)
-        self._surface = None
+        self._tileset = None
+        self._changed = set()
+        self._rewritten = False
+        self._init_surfaces()
+
+    def invalidate(self):
+        """Throws away everything rendered for the layer, so it's redrawn from
+scratch (needed after changing tiles without set_cell)"""
+        surface_cache.discard_owner(self._surface_key)
+        self._dirty.clear()
+        self._animated = None
+
+    def draw(self, image, pos, view=None):
+        """Draws the layer onto `image` with its top-left corner at `pos`.
+Only the chunks overlapping `view` (x, y, w, h in pixels, relative to the
+layer) are drawn; by default that's the part of the layer that ends up on
+`image`."""
+        self.update_chunks()
+        if view is None:
+            view = -pos[0], -pos[1], image.w, image.h
+        cx0, cy0, cx1, cy1 = _chunks_in_view(view, self.width, self.height)
+        for cy in range(cy0, cy1):
+            for cx in range(cx0, cx1):
+                if not self._is_empty_chunk(cx, cy):
+                    self.ctx.blit(image, self._get_chunk(cx, cy), (pos[0] + cx * CHUNK_PIXELS[0], pos[1] + cy * CHUNK_PIXELS[1]))
 
-    def draw(self, image, pos):
-        if self._surface is None:
-            self._regen_surface()
-        self.ctx.blit(image, self._surface, pos)
+    def animate(self, t):
+        """Shows animated tiles as they are at `t` seconds. Only the cells whose
+frame changed are redrawn, and only on chunks that are cached (the others
+get the right frame when they're rendered). Returns how many cells that is."""
+        old, self._anim_time = self._anim_time, t
+        tileset = self.tileset
+        if not tileset.animations:
+            return 0
+        count = 0
+        for tile, chunks in self._animated_cells().items():
+            if tileset.frame_index(tile, old) == tileset.frame_index(tile, t):
+                continue
+            for (cx, cy), cells in chunks.items():
+                if surface_cache.peek((self._surface_key, cx, cy)) is not None:
+                    self._dirty.update(cells)
+                    count += len(cells)
+        return count
 
-    def _regen_surface(self):
-        if len(self) == 0:
-            self._surface = self.ctx.empty_image(0, 0)
+    def _animated_cells(self):
+        if self._animated is None:
+            animations = self.tileset.animations
+            self._animated = {}
+            if not animations:
+                return self._animated
+            if self._is_sparse() and 0 not in animations:
+                for x, y, cell in self._layer.cells():
+                    if cell in animations:
+                        self._index_cells(cell, [(x, y)])
+            elif self._is_array():
+                for tile in animations:
+                    ys, xs = numpy.nonzero(self._layer == tile)
+                    self._index_cells(tile, zip(xs.tolist(), ys.tolist()))
+            else:
+                for y, row in enumerate(self._layer):
+                    for x, cell in enumerate(row):
+                        if cell in animations:
+                            self._index_cells(cell, [(x, y)])
+        return self._animated
+
+    def _index_cells(self, tile, cells):
+        chunks = self._animated.setdefault(tile, {})
+        for x, y in cells:
+            chunks.setdefault((x // SURFACE_CHUNK_SIZE, y // SURFACE_CHUNK_SIZE), set()).add((x, y))
+
+    def _reindex(self, cells):
+        # Moves changed cells to the right place in the index of animated ones
+        if self._animated is None:
             return
-        
-        size = len(self._layer[0]) * TILESIZE[0], len(self._layer) * TILESIZE[1]
-        self._surface = self.ctx.empty_image(*size)
-        for y, row in enumerate(self):
-            for x, cell in enumerate(row):
-                # print(self.tileset[cell])
-                self.ctx.blit(self._surface, self.tileset[cell], (x * TILESIZE[0], y * TILESIZE[1]))
+        animations = self._tileset.animations
+        for x, y in cells:
+            key = x // SURFACE_CHUNK_SIZE, y // SURFACE_CHUNK_SIZE
+            for chunks in self._animated.values():
+                if key in chunks:
+                    chunks[key].discard((x, y))
+            tile = int(self._layer[y][x])
+            if tile in animations:
+                self._index_cells(tile, [(x, y)])
+
+    def _shown_tiles(self):
+        # tile -> the frame it's currently shown as, for the animated ones
+        tileset = self.tileset
+        return {tile: tileset.frame(tile, self._anim_time) for tile in tileset.animations}
+
+    def update_chunks(self):
+        """Brings the cached chunks up to date with the tiles"""
+        # Chunks are only rendered from scratch if they aren't cached (or
+        # the tileset changed) or the layer was resized, otherwise just the
+        # cells changed since the last draw are redrawn
+        size = self.width, self.height
+        if size != self._rendered_size:
+            # Chunks on the right and bottom edges change size with the layer
+            self.invalidate()
+            self._rendered_size = size
+        elif self._dirty:
+            self._redraw_dirty()
+
+    def chunk(self, cx, cy):
+        """Returns (image, version) of chunk (cx, cy), or None if it's outside
+of the layer (or has nothing to draw in a sparse layer). The version changes
+whenever the image does. Call update_chunks() first."""
+        if not (0 <= cx < -(-self.width // SURFACE_CHUNK_SIZE) and 0 <= cy < -(-self.height // SURFACE_CHUNK_SIZE)):
+            return None
+        if self._is_empty_chunk(cx, cy):
+            return None
+        image = self._get_chunk(cx, cy)
+        return image, self._chunk_versions[cx, cy]
+
+    def chunk_is_opaque(self, cx, cy):
+        """Whether every pixel of chunk (cx, cy) is opaque, i.e. whatever is
+drawn under it doesn't show. Call chunk() first."""
+        version = self._chunk_versions[cx, cy]
+        cached = self._opaque_chunks.get((cx, cy))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        kinds = self.tileset.kinds
+        shown = self._shown_tiles()
+        x0, y0 = cx * SURFACE_CHUNK_SIZE, cy * SURFACE_CHUNK_SIZE
+        rows = self._rows(x0, y0, x0 + SURFACE_CHUNK_SIZE, y0 + SURFACE_CHUNK_SIZE)
+        opaque = all(kinds[shown.get(cell, cell)] == Tileset.OPAQUE for row in rows for cell in row)
+        self._opaque_chunks[cx, cy] = version, opaque
+        return opaque
+
+    def _is_empty_chunk(self, cx, cy):
+        # Only known without looking at the tiles for sparse layers
+        return self._is_sparse() and (cx, cy) not in self._layer.chunks and self._zero_is_empty()
+
+    def _zero_is_empty(self):
+        # Whether the cells a sparse layer leaves out can be skipped when
+        # drawing, which they can't if the tileset has something in tile 0
+        tileset = self.tileset
+        return tileset.source(tileset.frame(0, self._anim_time)) is None
+
+    def _get_chunk(self, cx, cy):
+        key = self._surface_key, cx, cy
+        chunk = surface_cache.get(key)
+        if chunk is not None:
+            return chunk
+
+        x0, y0 = cx * SURFACE_CHUNK_SIZE, cy * SURFACE_CHUNK_SIZE
+        x1 = min(x0 + SURFACE_CHUNK_SIZE, self.width)
+        y1 = min(y0 + SURFACE_CHUNK_SIZE, self.height)
+        chunk = self.ctx.empty_image((x1 - x0) * TILESIZE[0], (y1 - y0) * TILESIZE[1])
+        source = self.tileset.source
+        shown = self._shown_tiles()
+        if self._is_sparse() and self._zero_is_empty():
+            cells = ((x - x0, y - y0, cell) for (x, y), cell in self._layer.chunks.get((cx, cy), {}).items())
+        else:
+            cells = ((x, y, cell) for y, row in enumerate(self._rows(x0, y0, x1, y1)) for x, cell in enumerate(row))
+        blits = []
+        for x, y, cell in cells:
+            tile = source(shown.get(cell, cell))
+            if tile is not None:
+                blits.append((tile[0], (x * TILESIZE[0], y * TILESIZE[1]), tile[1]))
+        self.ctx.blit_many(chunk, blits)
+        surface_cache.put(key, chunk)
+        self._chunk_versions[cx, cy] = next(_chunk_versions)
+        return chunk
+
+    def _redraw_dirty(self):
+        shown = self._shown_tiles()
+        for x, y in self._dirty:
+            if x >= self.width or y >= self.height:
+                continue
+            # Chunks that aren't cached get the new tile when they're rendered
+            cx, cy = x // SURFACE_CHUNK_SIZE, y // SURFACE_CHUNK_SIZE
+            chunk = surface_cache.peek((self._surface_key, cx, cy))
+            if chunk is None:
+                continue
+            # Clear the cell first, tiles with transparent parts would
+            # otherwise be drawn over the old tile
+            loc = x % SURFACE_CHUNK_SIZE * TILESIZE[0], y % SURFACE_CHUNK_SIZE * TILESIZE[1]
+            self.ctx.fill_image(chunk, (0, 0, 0, 0), (loc, TILESIZE))
+            cell = int(self._layer[y][x])
+            tile = self.tileset.source(shown.get(cell, cell))
+            if tile is not None:
+                self.ctx.blit(chunk, tile[0], loc, tile[1])
+            self._chunk_versions[cx, cy] = next(_chunk_versions)
+        self._dirty.clear()
 
     def __iter__(self):
+        if self._is_array():
+            return (row.tolist() for row in self._layer)
         return iter(self._layer)
 
     def __getitem__(self, x):
-        return self._layer[x]
+        if not self._is_array():
+            return self._layer[x]
+        # Array rows would hand out NumPy ints, which serialize() and code
+        # comparing rows to lists don't expect
+        if isinstance(x, slice):
+            return [self[y] for y in range(*x.indices(self.height))]
+        if x < 0:
+            x += self.height
+        if not 0 <= x < self.height:
+            raise IndexError("row index out of range")
+        return _ArrayRow(self._layer, x)
 
     def __setitem__(self, x, y):
-        # Invalidate surface, forcing redraw
-        self._surface = None
+        same_width = len(y) == self.width
+        if self._is_sparse() and not same_width:
+            self._layer = self._make_dense(self._layer.rows(0, 0, self.width, self.height))
         self._layer[x] = y
+        if same_width:
+            self._touch_cells([(i, x) for i in range(len(y))])
+            self._check_storage()
+        else:
+            # Invalidate surface, forcing redraw; the journal can't express
+            # the new shape, so the next save writes the whole level
+            self.invalidate()
+            self._rewritten = True
 
     def __len__(self):
         return len(self._layer)
 
+    @property
+    def width(self):
+        if self._is_array():
+            return self._layer.shape[1]
+        if self._is_sparse():
+            return self._layer.width
+        return len(self._layer[0]) if self._layer else 0
+
+    @property
+    def height(self):
+        return len(self._layer)
+
+    def set_cell(self, x, y, tile):
+        """Sets one tile, keeping track of the change (see take_changes)"""
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise IndexError("cell (%d, %d) out of range" % (x, y))
+        self._layer[y][x] = tile
+        self._changed.add((x, y))
+        self._dirty.add((x, y))
+        self._reindex([(x, y)])
+        self._check_storage()
+
+    def cells(self):
+        """(x, y, tile) of every tile that isn't 0. For sparse layers this only
+takes time for those tiles."""
+        if self._is_sparse():
+            return self._layer.cells()
+        if self._is_array():
+            ys, xs = numpy.nonzero(self._layer)
+            return zip(xs.tolist(), ys.tolist(), self._layer[ys, xs].tolist())
+        return ((x, y, tile) for y, row in enumerate(self._layer) for x, tile in enumerate(row) if tile)
+
+    def resize(self, width, height, tile=0):
+        """Crops or extends the layer to width x height tiles, new cells are
+set to `tile`"""
+        if (width, height) == (self.width, self.height):
+            return
+        if self._is_sparse() and tile:
+            self._layer = self._make_dense(self._layer.rows(0, 0, self.width, self.height))
+        if self._is_sparse():
+            self._layer.resize(width, height)
+        elif self._is_array():
+            grid = numpy.full((height, width), tile, numpy.uint16)
+            h, w = min(height, self.height), min(width, self.width)
+            grid[:h, :w] = self._layer[:h, :w]
+            self._layer = grid
+        else:
+            del self._layer[height:]
+            for row in self._layer:
+                del row[width:]
+                row += [tile] * (width - len(row))
+            self._layer += [[tile] * width for _ in range(height - len(self._layer))]
+        # update_chunks() and LevelJournal only compare sizes, which another
+        # resize can bring back to what they were
+        self.invalidate()
+        self._rewritten = True
+        self._check_storage(recount=True)
+
+    def fill_region(self, x, y, width, height, tile):
+        """Sets every tile of the width x height rectangle at (x, y); the parts
+outside of the layer are skipped"""
+        self.stamp(x, y, [[tile]], width, height)
+
+    def stamp(self, x, y, pattern, width=None, height=None):
+        """Copies `pattern` (rows of tiles) to (x, y), repeating it to cover
+width x height tiles (by default it's copied once). The parts outside of the
+layer are skipped."""
+        if not pattern or not len(pattern[0]):
+            return
+        ph, pw = len(pattern), len(pattern[0])
+        if width is None:
+            width = pw
+        if height is None:
+            height = ph
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + width, self.width), min(y + height, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        if self._is_sparse() and (x1 - x0) * (y1 - y0) > 2 * (self.sparse_density or 0) * self.width * self.height:
+            # Likely to fill it up, dense storage does big stamps faster
+            self._layer = self._make_dense(self._layer.rows(0, 0, self.width, self.height))
+
+        # Cells keep the pattern position they'd have if nothing was cut off
+        if self._is_sparse():
+            for ty in range(y0, y1):
+                prow = pattern[(ty - y) % ph]
+                for tx in range(x0, x1):
+                    self._layer.set(tx, ty, prow[(tx - x) % pw])
+        elif self._is_array():
+            ox, oy = (x0 - x) % pw, (y0 - y) % ph
+            tiles = numpy.tile(numpy.array(pattern, numpy.uint16),
+                               (-(-(oy + y1 - y0) // ph), -(-(ox + x1 - x0) // pw)))
+            self._layer[y0:y1, x0:x1] = tiles[oy:oy + y1 - y0, ox:ox + x1 - x0]
+        else:
+            for ty in range(y0, y1):
+                prow = pattern[(ty - y) % ph]
+                self._layer[ty][x0:x1] = [prow[(tx - x) % pw] for tx in range(x0, x1)]
+
+        self._touch_region(x0, y0, x1, y1)
+        self._check_storage()
+
+    def remap(self, mapping):
+        """Replaces every tile `old` that's in `mapping` by mapping[old]"""
+        if self._is_sparse() and mapping.get(0, 0) != 0:
+            self._layer = self._make_dense(self._layer.rows(0, 0, self.width, self.height))
+        if self._is_sparse():
+            changed = [(x, y) for x, y, cell in list(self._layer.cells()) if mapping.get(cell, cell) != cell]
+            for x, y in changed:
+                cell = self._layer.get(x, y)
+                self._layer.set(x, y, mapping[cell])
+            self._touch_cells(changed)
+            self._check_storage()
+            return
+        if self._is_array():
+            table = numpy.arange(0x10000, dtype=numpy.uint16)
+            table[list(mapping)] = list(mapping.values())
+            new = table[self._layer]
+            ys, xs = numpy.nonzero(new != self._layer)
+            self._layer = new
+            if len(xs) > self.BULK_CELLS:
+                self._touch_region(int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1)
+            else:
+                self._touch_cells(list(zip(xs.tolist(), ys.tolist())))
+            self._check_storage(recount=True)
+            return
+
+        changed = []
+        for y, row in enumerate(self._layer):
+            for x, cell in enumerate(row):
+                if cell in mapping and mapping[cell] != cell:
+                    row[x] = mapping[cell]
+                    changed.append((x, y))
+        self._touch_cells(changed)
+        self._check_storage(recount=True)
+
+    def _touch_cells(self, cells):
+        self._changed.update(cells)
+        self._dirty.update(cells)
+        self._reindex(cells)
+
+    def _touch_region(self, x0, y0, x1, y1):
+        # Records a change of every cell in the rectangle
+        if (x1 - x0) * (y1 - y0) <= self.BULK_CELLS:
+            self._touch_cells([(x, y) for y in range(y0, y1) for x in range(x0, x1)])
+            return
+        self._rewritten = True
+        self._animated = None
+        for cy in range(y0 // SURFACE_CHUNK_SIZE, (y1 - 1) // SURFACE_CHUNK_SIZE + 1):
+            for cx in range(x0 // SURFACE_CHUNK_SIZE, (x1 - 1) // SURFACE_CHUNK_SIZE + 1):
+                surface_cache.discard((self._surface_key, cx, cy))
+        self._check_storage(recount=True)
+
+    def _rows(self, x0, y0, x1, y1):
+        # The tiles of a rectangle, as lists of ints
+        if self._is_sparse():
+            return self._layer.rows(x0, y0, x1, y1)
+        if self._is_array():
+            return self._layer[y0:y1, x0:x1].tolist()
+        return [row[x0:x1] for row in self._layer[y0:y1]]
+
+    def snapshot(self):
+        """Copy of the layer that later edits won't affect (rows are copied,
+tiles and the tileset are shared)"""
+        # Made around a copy of the storage as it is: going through __init__
+        # would convert and check every tile again, and this runs on the
+        # editor's thread at every save
+        res = TileLayer.__new__(TileLayer)
+        res.__init_deserialize__()
+        res.ctx = self.ctx
+        if self._is_array() or self._is_sparse():
+            res._layer = self._layer.copy()
+        else:
+            res._layer = [row[:] for row in self._layer]
+        res.tileset_name = self.tileset_name
+        if self._tileset is not None:
+            res._tileset = self._tileset
+            self._tileset.add_user(res)
+        return res
+
+    def take_changes(self):
+        """Returns the (x, y, tile) of every cell changed through set_cell since
+the last call, and forgets them"""
+        changes = [(x, y, int(self._layer[y][x])) for x, y in sorted(self._changed, key=lambda c: (c[1], c[0]))
+                   if x < self.width and y < self.height]
+        self._changed.clear()
+        return changes
+
     def dump(self):
-        res = serialize(len(self._layer[0])) + serialize(len(self._layer)) + serialize(self.tileset.name)
-        for y in range(len(self._layer)):
-            for x in range(len(self._layer[0])):
-                d = serialize(self._layer[y][x])
-                dtype = d[0]
-                res += d[1:]
+        # The leading byte says how the cells are encoded: "A" is a single
+        # packed array, "C" is run-length encoded rows squeezed by one of
+        # LAYER_COMPRESSORS (named right after the header), "S" is the
+        # positions (y * width + x) and the tiles of just the cells that
+        # aren't 0, as two packed arrays; sparse layers are always written
+        # that way, or as "Z" (the same two arrays squeezed like "C") when
+        # compressed. Older levels stored one untagged varint per cell.
+        header = serialize(self.width) + serialize(self.height) + serialize(self.tileset_name)
+        if self.compression is not None and self.compression not in LAYER_COMPRESSORS:
+            raise ValueError("unknown layer compression %r" % self.compression)
 
-        return bytes([dtype]) + res
+        if self._is_sparse():
+            cells = sorted((y * self.width + x, tile) for x, y, tile in self._layer.cells())
+            arrays = serialize(pack_ints([i for i, _ in cells])) + serialize(pack_ints([tile for _, tile in cells]))
+            if self.compression is None:
+                return b"S" + header + arrays
+            compress = LAYER_COMPRESSORS[self.compression][0]
+            return b"Z" + header + serialize(self.compression) + serialize(compress(arrays))
+
+        if self.compression is None:
+            if self._is_array():
+                return b"A" + header + serialize(self._pack_array())
+            rows = self._rows(0, 0, self.width, self.height)
+            return b"A" + header + serialize(pack_ints([cell for row in rows for cell in row]))
+
+        compress = LAYER_COMPRESSORS[self.compression][0]
+        # Runs never cross rows, they're (count, tile) pairs in one array
+        if self._is_array():
+            runs = self._array_runs()
+        else:
+            runs = []
+            for row in self._layer:
+                for tile, group in itertools.groupby(row):
+                    runs += (sum(1 for _ in group), tile)
+        return b"C" + header + serialize(self.compression) + serialize(compress(serialize(pack_ints(runs))))
+
+    def _pack_array(self):
+        # pack_ints() of every tile of array storage, without going through
+        # Python ints
+        hi = int(self._layer.max()) if self._layer.size else 0
+        typecode, dtype = ("B", numpy.uint8) if hi < 0x100 else ("H", numpy.uint16)
+        res = array.array(typecode)
+        res.frombytes(self._layer.astype(dtype).tobytes())
+        return res
+
+    def _array_runs(self):
+        # The (count, tile) pairs dump() writes, for array storage
+        flat = self._layer.ravel()
+        if not flat.size:
+            return []
+        starts = numpy.ones(flat.size, bool)
+        starts[1:] = flat[1:] != flat[:-1]
+        starts[::self.width] = True
+        starts = numpy.flatnonzero(starts)
+        runs = numpy.empty(2 * len(starts), numpy.int64)
+        runs[0::2] = numpy.diff(numpy.append(starts, flat.size))
+        runs[1::2] = flat[starts]
+        return runs.tolist()
 
     @classmethod
-    def load(cls, data):
-        ctx = _gui.Context.current_ctx
-        
-        dtype = data[0:1]
+    def read_header(cls, data):
+        """Returns (width, height, tileset_name) from a dump()ed layer without
+touching the tiles"""
+        return cls._read_header(data)[1:4]
+
+    @classmethod
+    def _read_header(cls, data):
+        dtype = bytes(data[0:1])
         offs = 1
         width, offs = deserialize(data, offs)
         height, offs = deserialize(data, offs)
         tileset_name, offs = deserialize(data, offs)
-        tileset = Tileset(ctx, os.path.join(TILESET_DIR, tileset_name + ".png"), tileset_name)
-
-        layer = []
-        for y in range(height):
-            row = []
-            for x in range(width):
-                v, doffs = deserialize(dtype + data[offs:], 0)
-                offs += doffs - 1
-                row.append(v)
-            layer.append(row)
+        return dtype, width, height, tileset_name, offs
+
+    @classmethod
+    def _decompress(cls, data, offs):
+        # The compressed payload of a "C" or "Z" layer, after the header
+        method, offs = deserialize(data, offs)
+        if method not in LAYER_COMPRESSORS:
+            raise ValueError("unknown layer compression %r" % method)
+        blob, offs = deserialize_blob(data, offs)
+        return LAYER_COMPRESSORS[method][1](blob)
+
+    @classmethod
+    def load(cls, data):
+        dtype, width, height, tileset_name, offs = cls._read_header(data)
+
+        if dtype in (b"S", b"Z"):
+            if dtype == b"Z":
+                data, offs = cls._decompress(data, offs), 0
+            positions, offs = deserialize(data, offs)
+            tiles, offs = deserialize(data, offs)
+            if len(positions) != len(tiles) or (len(positions) and max(positions) >= width * height):
+                raise ValueError("bad sparse layer of %dx%d tiles" % (width, height))
+            grid = SparseGrid(width, height, ((i % width, i // width, tile) for i, tile in zip(positions, tiles)))
+            return cls(tileset_name, grid)
+        if dtype == b"A":
+            cells, offs = deserialize(data, offs)
+        elif dtype == b"C":
+            runs = deserialize(cls._decompress(data, offs), 0)[0]
+            cells = []
+            it = iter(runs)
+            for count, tile in zip(it, it):
+                cells += [tile] * count
+        elif dtype == b"I":
+            cells, offs = unpack_varints(data, offs, width * height)
+        elif dtype == b"i":
+            cells = struct.unpack_from("%di" % (width * height), data, offs)
+        else:
+            raise ValueError("unknown tile encoding %r" % dtype)
+
+        if len(cells) != width * height:
+            raise ValueError("expected %d tiles, got %d" % (width * height, len(cells)))
+
+        if cls.storage == "numpy" and numpy is not None:
+            layer = numpy.asarray(cells).reshape(height, width)
+        else:
+            layer = [list(cells[y * width:(y + 1) * width]) for y in range(height)]
         
-        return cls(tileset, layer)
+        return cls(tileset_name, layer)
 
 @Serializable("Entity", exclude=["script", "map"])
 class Entity():
@@ -164,9 +1249,33 @@ class Entity():
         # self.map will be set by the Map object after it's deserialized
         self.script = scripts.SCRIPTS[self.script_name]
 
+    def snapshot(self):
+        res = Entity.__new__(Entity)
+        res.name = self.name
+        res.script = self.script
+        res.script_name = self.script_name
+        res.attributes = dict(self.attributes)
+        res.map = self.map
+        return res
+
     def draw(self, surface, offset):
         self.script.draw(self, surface, offset)
 
+    def visible(self, view):
+        """Whether the entity can be seen in `view` (x, y, w, h in pixels, in
+the same space as the offset passed to draw()). Scripts can define
+bounds(ent), returning the rectangle the entity is drawn in (or None to
+always draw it). Without it, entities with "x" and "y" attributes are taken
+to cover one tile there, and the others are always drawn."""
+        bounds = getattr(self.script, "bounds", None)
+        if bounds is not None:
+            rect = bounds(self)
+        elif "x" in self.attributes and "y" in self.attributes:
+            rect = self.attributes["x"], self.attributes["y"], TILESIZE[0], TILESIZE[1]
+        else:
+            rect = None
+        return rect is None or _rects_overlap(rect, view)
+
     def update(self):
         self.script.update(self)
 
@@ -181,16 +1290,106 @@ class Entity():
 @UserSerializable("Map")
 class Map():
 
+    # Position of the top-left tile, in tiles; not (0, 0) for maps that only
+    # hold part of a level (see ChunkedLevel.load_region)
+    origin = (0, 0)
+
+    # Layers before this one are drawn below the entities, the rest above
+    ENTITY_LAYER = 2
+
+    # Bumped by every LevelJournal compaction, so journals that were already
+    # folded into the level file can be told apart. Only written when set.
+    generation = 0
+
+    # Owner of the map's composites in surface_cache, set on the first draw
+    _composite_key = None
+
     def __init__(self, layers, entities):
         self.layers = layers
         self.entities = entities
 
-    def draw(self, surface, pos):
-        self.layers[0].draw(surface, pos)
-        self.layers[1].draw(surface, pos)
+    def draw(self, surface, pos, view=None):
+        """Draws the map onto `surface` with the level's top-left corner at
+`pos`. `view` is the camera rectangle (x, y, w, h in level pixels); only
+tiles and entities inside it are drawn. It defaults to the part of the level
+that ends up on `surface`."""
+        self.draw_background(surface, pos, view)
+        layer_pos, layer_view = self._layer_view(surface, pos, view)
         for entity in self.entities:
-            entity.draw(surface, pos)
-        self.layers[2].draw(surface, pos)
+            if entity.visible(layer_view):
+                entity.draw(surface, layer_pos)
+        self.draw_overlay(surface, pos, view)
+
+    def draw_background(self, surface, pos, view=None):
+        """Draws the layers below the entities, like draw()"""
+        self._draw_composite(surface, pos, view, "background", self.layers[:self.ENTITY_LAYER])
+
+    def draw_overlay(self, surface, pos, view=None):
+        """Draws the layers above the entities, like draw()"""
+        self._draw_composite(surface, pos, view, "overlay", self.layers[self.ENTITY_LAYER:])
+
+    def _layer_view(self, surface, pos, view):
+        if view is None:
+            view = -pos[0], -pos[1], surface.w, surface.h
+        ox, oy = self.origin[0] * TILESIZE[0], self.origin[1] * TILESIZE[1]
+        return (pos[0] + ox, pos[1] + oy), (view[0] - ox, view[1] - oy, view[2], view[3])
+
+    def _draw_composite(self, surface, pos, view, kind, layers):
+        # The layers are flattened chunk by chunk into composites kept in
+        # surface_cache, which are rebuilt when a chunk below them changes.
+        # Alpha blending isn't associative, so that only draws the same
+        # pixels as blitting the layers one by one if the bottom layer covers
+        # the chunk with opaque tiles; other chunks are drawn layer by layer.
+        pos, view = self._layer_view(surface, pos, view)
+        if len(layers) == 1:
+            layers[0].draw(surface, pos, view)
+            return
+        if not layers:
+            return
+        if self._composite_key is None:
+            self._composite_key = object()
+            self._composite_versions = {}
+
+        for layer in layers:
+            layer.update_chunks()
+        width = max(layer.width for layer in layers)
+        height = max(layer.height for layer in layers)
+        ctx = layers[0].ctx
+        cx0, cy0, cx1, cy1 = _chunks_in_view(view, width, height)
+        for cy in range(cy0, cy1):
+            for cx in range(cx0, cx1):
+                bottom = layers[0].chunk(cx, cy)
+                chunks = [chunk for chunk in [bottom] + [layer.chunk(cx, cy) for layer in layers[1:]] if chunk is not None]
+                if not chunks:
+                    continue
+                loc = pos[0] + cx * CHUNK_PIXELS[0], pos[1] + cy * CHUNK_PIXELS[1]
+                size = max(image.w for image, _ in chunks), max(image.h for image, _ in chunks)
+                if bottom is None or (bottom[0].w, bottom[0].h) != size or not layers[0].chunk_is_opaque(cx, cy):
+                    ctx.blit_many(surface, [(image, loc, None) for image, _ in chunks])
+                    continue
+
+                key = self._composite_key, kind, cx, cy
+                versions = [version for _, version in chunks]
+                composite = surface_cache.get(key)
+                if composite is None or self._composite_versions.get(key) != versions:
+                    composite = ctx.empty_image(*size)
+                    ctx.blit_many(composite, [(image, (0, 0), None) for image, _ in chunks])
+                    surface_cache.put(key, composite)
+                    self._composite_versions[key] = versions
+                ctx.blit(surface, composite, loc)
+
+    def animate(self, t):
+        """Shows animated tiles as they are at `t` seconds (see
+TileLayer.animate), returns how many cells changed"""
+        return sum(layer.animate(t) for layer in self.layers)
+
+    def snapshot(self):
+        """Copy of the map to save from another thread while editing goes on"""
+        entities = type(self.entities)(ent.snapshot() for ent in self.entities)
+        res = Map._from_loaded([layer.snapshot() for layer in self.layers], entities)
+        res.origin = self.origin
+        res.generation = self.generation
+        return res
 
     def update(self):
         for entity in self.entites:
@@ -200,15 +1399,518 @@ class Map():
         res = b""
         res += serialize(self.layers)
         res += serialize(self.entities)
+        if self.generation:
+            res += serialize(self.generation)
         return res
 
+    def dump_to(self, f):
+        # Streamed counterpart of dump(), used by serialize_to()
+        serialize_to(self.layers, f)
+        serialize_to(self.entities, f)
+        if self.generation:
+            serialize_to(self.generation, f)
+
     @classmethod
     def load(cls, data):
         i = 0
         layers, i = deserialize(data, i)
         entities, i = deserialize(data, i)
+        res = cls._from_loaded(layers, entities)
+        if i < len(data):
+            res.generation, i = deserialize(data, i)
+        return res
+
+    @classmethod
+    def load_region(cls, filename, x, y, w, h):
+        """Loads part of a chunked level file (see save_chunked_level)"""
+        level = ChunkedLevel(filename)
+        try:
+            return level.load_region(x, y, w, h)
+        finally:
+            level.close()
+
+    @classmethod
+    def load_from(cls, f, size):
+        # Streamed counterpart of load(), used by deserialize_from()
+        end = f.tell() + size
+        layers = deserialize_from(f)
+        entities = deserialize_from(f)
+        res = cls._from_loaded(layers, entities)
+        if f.tell() < end:
+            res.generation = deserialize_from(f)
+        return res
+
+    @classmethod
+    def _from_loaded(cls, layers, entities):
         res = cls(layers, entities)
         for ent in entities:
             ent.map = res
 
         return res
+
+class LazyLayers():
+
+    """Read-only list of a LazyMap's layers, decoding each one on first access"""
+
+    def __init__(self, data, spans, strings=None):
+        self._data = data
+        self._spans = spans
+        self._strings = strings
+        self._layers = [None] * len(spans)
+
+    def __len__(self):
+        return len(self._spans)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if self._layers[i] is None:
+            start, end = self._spans[i]
+            with using_strings(self._strings):
+                self._layers[i] = deserialize(self._data[start:end], 0)[0]
+        return self._layers[i]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def header(self, i):
+        """(width, height, tileset_name) of layer i, without decoding its tiles"""
+        start, end = self._spans[i]
+        with using_strings(self._strings):
+            _, pstart, pend = user_payload(self._data, start)
+            return TileLayer.read_header(self._data[pstart:pend])
+
+    def is_loaded(self, i):
+        return self._layers[i] is not None
+
+# Registered under the same name so it's written out as a regular Map; loading
+# still goes through Map, which was registered first
+@UserSerializable("Map")
+class LazyMap(Map):
+
+    """Map backed by a memory-mapped level file (see open_level). Layers and
+entities are decoded the first time they are accessed"""
+
+    def __init__(self, data, mm=None, strings=None):
+        self._mmap = mm
+        self._data = data
+        self._strings = strings
+
+        offs = 0
+        if data[offs] != ord("L"):
+            raise ValueError("at offset %d: expected list of layers" % offs)
+        count, offs = deserialize(data, offs + 1)
+        spans = []
+        for _ in range(count):
+            end = skip(data, offs)
+            spans.append((offs, end))
+            offs = end
+        self.layers = LazyLayers(data, spans, strings)
+        self._entities_offs = offs
+        self._entities = None
+        offs = skip(data, offs)
+        if offs < len(data):
+            self.generation = deserialize(data, offs)[0]
+
+    @property
+    def entities(self):
+        if self._entities is None:
+            with using_strings(self._strings):
+                entities = deserialize(self._data, self._entities_offs)[0]
+            for ent in entities:
+                ent.map = self
+            self._entities = entities
+        return self._entities
+
+    @entities.setter
+    def entities(self, value):
+        self._entities = value
+
+    def dump(self):
+        # Sections that were never decoded can't have changed, so they're
+        # copied over as they are (unless they refer to the string table)
+        generation = serialize(self.generation) if self.generation else b""
+        if self._strings is not None:
+            return serialize(list(self.layers)) + serialize(self.entities) + generation
+        out = bytearray(b"L")
+        out += serialize(len(self.layers))
+        for i, (start, end) in enumerate(self.layers._spans):
+            if self.layers.is_loaded(i):
+                out += serialize(self.layers[i])
+            else:
+                out += self._data[start:end]
+        if self._entities is None:
+            out += self._data[self._entities_offs:skip(self._data, self._entities_offs)]
+        else:
+            out += serialize(self._entities)
+        out += generation
+        return bytes(out)
+
+    def dump_to(self, f):
+        f.write(self.dump())
+
+    def close(self):
+        """Releases the mapped file; anything not decoded yet is lost"""
+        self.layers._data = self._data = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+def open_level(filename, lazy=False):
+    """Loads a level file. With lazy=True the file is mmap'ed and the returned
+LazyMap only decodes the layers and entities that are actually used"""
+    if not lazy:
+        with open(filename, "rb") as f:
+            return deserialize_from(f)
+
+    with open(filename, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    data = memoryview(mm)
+    strings, offs = read_strings(data, 0)
+    with using_strings(strings):
+        objname, start, end = user_payload(data, offs)
+    if objname != USER_SERIALIZABLES[Map]:
+        raise ValueError("%s: not a map (\"%s\")" % (filename, objname))
+    return LazyMap(data[start:end], mm, strings)
+
+# Chunked level files: a header tuple (magic, version, chunk size, layers,
+# entities offset) followed by a data area. Each layer is stored as packed
+# arrays of chunk_size x chunk_size tiles (smaller at the right and bottom
+# edges), row by row, and its header entry is (width, height, tileset name,
+# offsets) where offsets has the start of every chunk plus the end of the last
+# one, relative to the data area. This lets ChunkedLevel read any rectangle of
+# the map without touching the rest of the file.
+
+CHUNKED_LEVEL_MAGIC = "game_types::ChunkedMap"
+CHUNKED_LEVEL_VERSION = 1
+
+def save_chunked_level(filename, map, chunk_size=CHUNK_SIZE):
+    data = bytearray()
+    layers = []
+    for layer in map.layers:
+        width, height = layer.width, layer.height
+        offsets = []
+        for cy in range(0, height, chunk_size):
+            for cx in range(0, width, chunk_size):
+                rows = layer._rows(cx, cy, cx + chunk_size, cy + chunk_size)
+                offsets.append(len(data))
+                data += serialize(pack_ints([cell for row in rows for cell in row]))
+        offsets.append(len(data))
+        layers.append((width, height, layer.tileset_name, pack_ints(offsets)))
+
+    entities_offs = len(data)
+    data += serialize(map.entities)
+
+    # Replaced atomically, like in write_level()
+    tmp = filename + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(serialize((CHUNKED_LEVEL_MAGIC, CHUNKED_LEVEL_VERSION, chunk_size, layers, entities_offs)))
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+class ChunkedLevel():
+
+    """Random access reader for files written by save_chunked_level. Only the
+header is decoded up front; load_region() reads just the chunks it needs"""
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._data = memoryview(self._mmap)
+
+        header, self._start = deserialize(self._data, 0)
+        if type(header) is not tuple or len(header) != 5 or header[0] != CHUNKED_LEVEL_MAGIC:
+            raise ValueError("%s: not a chunked level file" % filename)
+        if header[1] != CHUNKED_LEVEL_VERSION:
+            raise ValueError("%s: unsupported chunked level version %r" % (filename, header[1]))
+        _, _, self.chunk_size, self._layers, self._entities_offs = header
+
+    def __len__(self):
+        return len(self._layers)
+
+    def header(self, i):
+        """(width, height, tileset_name) of layer i"""
+        return tuple(self._layers[i][:3])
+
+    def load_chunk(self, i, cx, cy):
+        """Returns the tiles of chunk (cx, cy) of layer i, as a list of rows"""
+        width, height, _, offsets = self._layers[i]
+        cols = -(-width // self.chunk_size)
+        cells, _ = deserialize(self._data, self._start + offsets[cy * cols + cx])
+        chunk_width = min(self.chunk_size, width - cx * self.chunk_size)
+        return [cells[y:y + chunk_width].tolist() for y in range(0, len(cells), chunk_width)]
+
+    def load_region(self, x, y, w, h):
+        """Loads the chunks intersecting the rectangle (x, y, w, h), in tiles.
+The returned Map's origin is the top-left corner of the first chunk."""
+        cs = self.chunk_size
+        cx0, cy0 = max(x, 0) // cs, max(y, 0) // cs
+        layers = []
+        for i, (width, height, tileset_name, _) in enumerate(self._layers):
+            cx1 = min(x + w, width) - 1
+            cy1 = min(y + h, height) - 1
+            rows = []
+            for cy in range(cy0, cy1 // cs + 1):
+                chunk_rows = [[] for _ in range(min(cs, height - cy * cs))]
+                for cx in range(cx0, cx1 // cs + 1):
+                    for row, chunk_row in zip(chunk_rows, self.load_chunk(i, cx, cy)):
+                        row += chunk_row
+                rows += chunk_rows
+            layers.append(TileLayer(tileset_name, rows))
+
+        res = Map._from_loaded(layers, deserialize(self._data, self._start + self._entities_offs)[0])
+        res.origin = (cx0 * cs, cy0 * cs)
+        return res
+
+    def load(self):
+        return self.load_region(0, 0, max((l[0] for l in self._layers), default=0), max((l[1] for l in self._layers), default=0))
+
+    def close(self):
+        self._data = None
+        self._mmap.close()
+
+def write_level(filename, map):
+    """Saves a map, replacing the file atomically: it's written to a temporary
+file next to it first, so a crash never leaves a half-written level"""
+    tmp = filename + ".tmp"
+    with open(tmp, "wb") as f:
+        serialize_to(map, f, intern=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+class LevelJournal():
+
+    """Append-only log of tile edits, kept next to a level file as
+<filename>.journal. save() appends just the cells changed since the last save
+(as (layer index, packed x, y, tile triples) records), and the journal is
+folded back into the level file by compacting it.
+
+Compacting is split in two so the slow part can run on another thread:
+prepare_compaction() moves the journal aside to <filename>.journal.<n>, and
+finish_compaction() writes a Map.snapshot() to the level file and then
+deletes the moved journals. Every compaction gives the level file the next
+Map.generation, and every journal starts with a header saying which
+generation it applies to, and whether it also applies right after the
+journals of the one before (it doesn't after a resize or a bulk edit).
+replay() skips journals older than the level file and stops at the first one
+that doesn't apply. Replaying is idempotent and the journals always end with
+the latest value of every cell they touch, so a crash at any point leaves
+files that replay() recovers: to the snapshot if only cell edits were
+pending, otherwise (after a resize or a bulk edit) to the last save before
+it."""
+
+    COMPACT_RECORDS = 64
+    COMPACT_BYTES = 1 << 20
+
+    def __init__(self, filename, map):
+        self.filename = filename
+        self.journal_filename = filename + ".journal"
+        self.map = map
+        self._layout = self._get_layout()
+        self._records = 0
+        # Set when a compaction failed to write the level file, or replay()
+        # couldn't use every journal; the next save has to rewrite it,
+        # whatever the layers say
+        self._rewrite = False
+        # Header of the journal appended to, see replay()
+        self._generation = map.generation
+        self._continues = True
+
+    def _get_layout(self):
+        # Anything the journal can't express; if it changes, save() falls back
+        # to writing the whole level
+        return [(layer.width, layer.height, layer.tileset_name) for layer in self.map.layers]
+
+    def _moved_journals(self):
+        return self._find_moved_journals(self.journal_filename)
+
+    @staticmethod
+    def _find_moved_journals(journal_filename):
+        directory, name = os.path.split(os.path.abspath(journal_filename))
+        res = []
+        for i in os.listdir(directory):
+            suffix = i[len(name) + 1:]
+            if i.startswith(name + ".") and suffix.isdigit():
+                res.append((int(suffix), os.path.join(directory, i)))
+        return [i for _, i in sorted(res)]
+
+    def replay(self, repair=True):
+        """Applies the journals left by an earlier session to the map, returning
+the number of records applied. A torn last record (from a crash in the middle
+of a save) is dropped, and cut off the journal unless repair is False (then
+the files are only read)."""
+        count = 0
+        applied = newest = self.map.generation
+        broken = False
+        for filename in self._moved_journals() + [self.journal_filename]:
+            header, records = self._read_journal(filename, repair)
+            if header is None or header["generation"] < self.map.generation:
+                # Already in the level file; a crash kept it from being deleted
+                continue
+            newest = max(newest, header["generation"])
+            if not broken and header["generation"] == applied + 1 and header["continues"]:
+                applied += 1
+            # Otherwise it was written after a compaction that never made it
+            # to the level file, and doesn't go over the journals before it
+            broken = broken or header["generation"] != applied
+            if broken:
+                continue
+
+            for index, cells in records:
+                # Cells outside of the layer are from before it was resized
+                if index >= len(self.map.layers):
+                    continue
+                layer = self.map.layers[index]
+                width, height = layer.width, layer.height
+                for i in range(0, len(cells) - 2, 3):
+                    if cells[i] < width and cells[i + 1] < height:
+                        layer._layer[cells[i + 1]][cells[i]] = cells[i + 2]
+                layer.invalidate()
+            count += len(records)
+            if filename == self.journal_filename:
+                self._records = len(records)
+
+        # The next compaction has to get past every journal on disk, and a
+        # journal that couldn't be used mustn't be appended to
+        self._generation = newest
+        self._rewrite = self._rewrite or broken
+        return count
+
+    def _read_journal(self, filename, repair):
+        # Returns the header and the records of a journal, or None and [] if
+        # there's none
+        try:
+            f = open(filename, "r+b" if repair else "rb")
+        except FileNotFoundError:
+            return None, []
+
+        header = None
+        records = []
+        with f:
+            good = 0
+            while True:
+                try:
+                    record = deserialize_from(f)
+                except EOFError:
+                    break
+                except (ValueError, TypeError):
+                    warnings.warn(UserWarning("%s: dropping damaged journal data at offset %d" % (filename, good)))
+                    if repair:
+                        f.truncate(good)
+                    break
+                good = f.tell()
+                if header is None:
+                    header = record
+                else:
+                    records.append(record)
+
+        return header, records
+
+    def needs_compaction(self):
+        """Whether the next save has to write the whole level"""
+        if self._rewrite or self._get_layout() != self._layout or not os.path.exists(self.filename):
+            return True
+        if any(layer._rewritten for layer in self.map.layers):
+            return True
+        if self._records >= self.COMPACT_RECORDS:
+            return True
+        try:
+            return os.path.getsize(self.journal_filename) >= self.COMPACT_BYTES
+        except FileNotFoundError:
+            return False
+
+    def save(self, submit=None):
+        """Saves the changes since the last save, either by appending them to
+the journal or, when needed, by rewriting the level file. The level file is
+written by calling submit(function, *args) if it's given (an executor's
+submit(), say), and what that returns is returned; otherwise it's written
+before save() returns None."""
+        if not self.needs_compaction():
+            self.append()
+        elif submit is None:
+            self.compact()
+        else:
+            snapshot = self.map.snapshot()
+            return submit(self.finish_compaction, snapshot, self.prepare_compaction())
+
+    def append(self):
+        """Appends the changes since the last save to the journal"""
+        out = bytearray()
+        for index, layer in enumerate(self.map.layers):
+            changes = layer.take_changes()
+            if changes:
+                out += serialize((index, pack_ints([v for cell in changes for v in cell])))
+                self._records += 1
+        if not out:
+            return
+
+        with open(self.journal_filename, "ab") as f:
+            if not f.tell():
+                f.write(serialize({"generation": self._generation, "continues": self._continues}))
+            f.write(out)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def compact(self):
+        """Writes the whole map (including unsaved changes) to the level file
+and empties the journal"""
+        self.finish_compaction(self.map, self.prepare_compaction())
+
+    def prepare_compaction(self):
+        """Starts a compaction of the map in its current state; call this
+together with Map.snapshot(). Later saves go to a new journal."""
+        # The moved journal gets every change up to now, so replaying it over
+        # either the old level file or the snapshot gives the snapshot; that
+        # keeps a crash before finish_compaction() is done harmless. Unless
+        # edits the journal can't express are pending: then the cell edits
+        # alone would replay into a level that never existed, so they're
+        # dropped, the next journal says it doesn't follow this one, and a
+        # crash rolls back to the last save instead.
+        rewrite = self._rewrite or self._get_layout() != self._layout or any(layer._rewritten for layer in self.map.layers)
+        if rewrite:
+            for layer in self.map.layers:
+                layer.take_changes()
+        else:
+            self.append()
+        self._layout = self._get_layout()
+        self._records = 0
+        self._rewrite = False
+        self._generation += 1
+        self._continues = not rewrite
+        for layer in self.map.layers:
+            layer._rewritten = False
+
+        moved = self._moved_journals()
+        if os.path.exists(self.journal_filename):
+            n = int(moved[-1].rsplit(".", 1)[1]) + 1 if moved else 0
+            os.replace(self.journal_filename, "%s.%d" % (self.journal_filename, n))
+            moved.append("%s.%d" % (self.journal_filename, n))
+        return moved
+
+    def finish_compaction(self, snapshot, moved):
+        """Writes `snapshot` to the level file and removes the journals
+returned by prepare_compaction(). Safe to run on another thread."""
+        snapshot.generation = self._generation
+        try:
+            write_level(self.filename, snapshot)
+        except BaseException:
+            # prepare_compaction() already forgot what made this compaction
+            # necessary, and the journal may be missing edits it dropped
+            self._rewrite = True
+            raise
+        for filename in moved:
+            os.remove(filename)
+
+    @classmethod
+    def compact_file(cls, filename):
+        """Folds a level's journal into it, without any unsaved changes an open
+editor might have"""
+        if not os.path.exists(filename + ".journal") and not cls._find_moved_journals(filename + ".journal"):
+            return
+        journal = cls(filename, open_level(filename))
+        journal.replay()
+        journal.compact()
@@ -279,6 +279,18 @@ class Context(abc.ABC):
     def scale_image(self, image, newres):
         ...
 
+    def alpha_coverage(self, image, bbox):
+        # Returns (visible, opaque), how many pixels in the bbox of image
+        # aren't fully transparent and how many are fully opaque, or None if
+        # the context can't tell
+        return None
+
+    def blit_many(self, dst, blits):
+        # Blits every (src, loc, bbox) in `blits` onto dst, in order. Contexts
+        # that can do it in one call should override this.
+        for src, loc, bbox in blits:
+            self.blit(dst, src, loc, bbox)
+
 class EventType:
     
     def __new__(self):
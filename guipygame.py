@@ -8,6 +8,11 @@ class PygameContext(Context):
     class MainloopExit(Exception):
         pass
 
+    # Loaded images with no partially transparent pixels and at least this
+    # much transparent area are stored colorkeyed and RLE accelerated
+    RLE_TRANSPARENCY = 0.5
+    COLORKEY = (255, 0, 255)
+
     def __init__(self, width, height):
         _pygame.init()
         self._screen_size = Vector2(width, height)
@@ -18,6 +23,8 @@ class PygameContext(Context):
         self.last_specials = []
         self.clock = _pygame.time.Clock()
         self.intervals = []
+        # (name, width, height, format) of every image load_image() loaded
+        self.image_report = []
         self.title("PygameContext")
 
     def get_frametime(self):
@@ -32,12 +39,15 @@ class PygameContext(Context):
             self.display = _pygame.display.set_mode((new.x, new.y))
         return self._screen_size
 
-    def fill_image(self, img, color):
-        img.data.fill(color)
+    def fill_image(self, img, color, rect=None):
+        img.data.fill(color, rect)
 
-    def empty_image(self, w, h):
-        x = _pygame.Surface((w, h), _pygame.SRCALPHA)
-        return Image(x.convert_alpha(), w, h)
+    def empty_image(self, w, h, alpha=True):
+        if alpha:
+            x = _pygame.Surface((w, h), _pygame.SRCALPHA).convert_alpha()
+        else:
+            x = _pygame.Surface((w, h)).convert()
+        return Image(x, w, h)
 
     def blit(self, dst, src, loc, bbox=None):
         if type(dst) != _pygame.Surface:
@@ -53,6 +63,14 @@ class PygameContext(Context):
         else:
             dst.blit(src, loc, bbox)
 
+    def alpha_coverage(self, image, bbox):
+        surf = image.data.subsurface(bbox)
+        return _pygame.mask.from_surface(surf, 0).count(), _pygame.mask.from_surface(surf, 254).count()
+
+    def blit_many(self, dst, blits):
+        # One Surface.blits call instead of a blit per tile
+        dst.data.blits([(src.data, loc) if bbox is None else (src.data, loc, bbox) for src, loc, bbox in blits], False)
+
     def PYGAMEsurface_to_image(self, surf):
         return Image(surf, surf.get_width(), surf.get_height())
 
@@ -113,10 +131,45 @@ Note 2: This function should not be used. Instead, use Widget.bind()"""
 
     def load_image(self, path_or_file, namehint=""):
         surf = _pygame.image.load(path_or_file, namehint)
-        surf.convert_alpha()
+        surf, fmt = self.PYGAMEnormalize_surface(surf)
+        name = path_or_file if isinstance(path_or_file, str) else namehint
+        self.image_report.append((name, surf.get_width(), surf.get_height(), fmt))
 
         return Image(surf, surf.get_width(), surf.get_height())
 
+    def PYGAMEnormalize_surface(self, surf):
+        """PygameContext-only function. Converts a loaded surface to the
+display's pixel format, returning (surface, format): "opaque" surfaces
+have no alpha at all, "colorkey" ones are fully transparent or opaque pixel
+by pixel and RLE accelerated, the rest keep per-pixel "alpha"."""
+        w, h = surf.get_size()
+        if surf.get_colorkey() is not None:
+            res = surf.convert()
+            res.set_colorkey(surf.get_colorkey(), _pygame.RLEACCEL)
+            return res, "colorkey"
+        if not surf.get_flags() & _pygame.SRCALPHA or w * h == 0:
+            return surf.convert(), "opaque"
+
+        visible = _pygame.mask.from_surface(surf, 0)
+        opaque = _pygame.mask.from_surface(surf, 254)
+        if opaque.count() == w * h:
+            return surf.convert(), "opaque"
+        if visible.count() == opaque.count() and 1 - opaque.count() / (w * h) >= self.RLE_TRANSPARENCY:
+            # Only usable if no visible pixel has the colorkey's color
+            key = _pygame.mask.from_threshold(surf, self.COLORKEY, (1, 1, 1, 255))
+            if not key.overlap_area(opaque, (0, 0)):
+                res = _pygame.Surface((w, h)).convert()
+                res.fill(self.COLORKEY)
+                res.blit(surf, (0, 0))
+                res.set_colorkey(self.COLORKEY, _pygame.RLEACCEL)
+                return res, "colorkey"
+        return surf.convert_alpha(), "alpha"
+
+    def PYGAMEprint_image_report(self):
+        """PygameContext-only function"""
+        for name, w, h, fmt in self.image_report:
+            print("%-40s %5dx%-5d %s" % (name, w, h, fmt))
+
     def get_text_dimensions(self, fontname, fontsize, text):
         if (fontname, fontsize) not in self.font_cache:
             self.font_cache[fontname, fontsize] = _pygame.font.SysFont(fontname, fontsize)
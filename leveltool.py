@@ -0,0 +1,121 @@
+## Usage:
+# python leveltool.py validate [-j JOBS] [PATH...]
+#   Decodes every level, encodes it again and checks the result decodes to
+#   the same map
+# python leveltool.py reencode [-j JOBS] [--out DIR] [--chunked]
+#                              [--compress zlib|lzma] [PATH...]
+#   Rewrites every level in the newest format (packed tiles, interned
+#   strings), or as a chunked level file with --chunked (which needs --out:
+#   the editor and open_level() can't read those). --compress compresses
+#   the tile layers (dense ones are run-length encoded first, sparse ones
+#   keep their list of cells). Saved edits still in a level's journal are
+#   folded in first; with --out they only go into the copy, and the level
+#   and its journal are left alone.
+# PATH can be a level file or a directory of levelN files (default: .)
+# Levels are handled in parallel by worker processes, which never open a
+# window; tilesets are only loaded when something is drawn.
+
+import os
+import re
+import sys
+import time
+import argparse
+import concurrent.futures
+from game_types import *
+
+LEVEL_NAME = re.compile(r"level\d+$")
+
+def find_levels(paths):
+    res = []
+    for path in paths:
+        if os.path.isdir(path):
+            names = sorted((i for i in os.listdir(path) if LEVEL_NAME.match(i)), key=lambda i: int(i[5:]))
+            res += [os.path.join(path, i) for i in names]
+        else:
+            res.append(path)
+    return res
+
+def same_map(a, b):
+    if len(a.layers) != len(b.layers):
+        return False
+    for la, lb in zip(a.layers, b.layers):
+        if la.tileset_name != lb.tileset_name or list(map(list, la)) != list(map(list, lb)):
+            return False
+    key = lambda ent: (ent.name, ent.script_name, repr(ent.attributes))
+    return sorted(map(key, a.entities)) == sorted(map(key, b.entities))
+
+def process_level(filename, command, out_dir=None, chunked=False, compression=None):
+    """Runs in a worker process; returns a report dict for the level"""
+    TileLayer.compression = compression
+    report = {"file": filename, "size": os.path.getsize(filename), "ok": True, "error": None}
+    try:
+        if command == "reencode" and out_dir is None:
+            LevelJournal.compact_file(filename)
+            report["size"] = os.path.getsize(filename)
+
+        t = time.perf_counter()
+        level = open_level(filename)
+        report["decode"] = time.perf_counter() - t
+        if command == "reencode" and out_dir is not None:
+            # The copy gets the saved edits too, the level and its journal
+            # are left as they are
+            LevelJournal(filename, level).replay(repair=False)
+
+        t = time.perf_counter()
+        data = serialize(level, intern=True)
+        report["encode"] = time.perf_counter() - t
+        report["new_size"] = len(data)
+
+        if not same_map(level, deserialize(memoryview(data), 0)[0]):
+            raise ValueError("re-encoded level doesn't match the original")
+
+        if command == "reencode":
+            out = filename if out_dir is None else os.path.join(out_dir, os.path.basename(filename))
+            if chunked:
+                save_chunked_level(out, level)
+            else:
+                write_level(out, level)
+            report["new_size"] = os.path.getsize(out)
+
+    except Exception as e:
+        report["ok"] = False
+        report["error"] = "%s: %s" % (type(e).__name__, e)
+
+    return report
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Batch level file tool")
+    parser.add_argument("command", choices=["validate", "reencode"])
+    parser.add_argument("paths", nargs="*", default=["."])
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes (default: one per CPU)")
+    parser.add_argument("--out", default=None, help="write re-encoded levels here instead of in place")
+    parser.add_argument("--chunked", action="store_true", help="re-encode as chunked level files")
+    parser.add_argument("--compress", choices=sorted(LAYER_COMPRESSORS), default=None, help="compress tile layers")
+    # Intermixed, so the paths can come after the options like in the usage
+    # above
+    args = parser.parse_intermixed_args(argv)
+    if args.chunked and args.out is None:
+        parser.error("--chunked needs --out, chunked files can't replace levels")
+
+    if args.out is not None:
+        os.makedirs(args.out, exist_ok=True)
+
+    levels = find_levels(args.paths)
+    failed = 0
+    t = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [pool.submit(process_level, i, args.command, args.out, args.chunked, args.compress) for i in levels]
+        for future in futures:
+            r = future.result()
+            if r["ok"]:
+                print("%-20s %9d -> %9d bytes  decode %8.2f ms  encode %8.2f ms" % (
+                    r["file"], r["size"], r["new_size"], r["decode"] * 1000, r["encode"] * 1000))
+            else:
+                failed += 1
+                print("%-20s FAILED: %s" % (r["file"], r["error"]))
+
+    print("%d levels, %d failed, %.2f s" % (len(levels), failed, time.perf_counter() - t))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -3,6 +3,14 @@ NAME = "picture"
 def draw(ent, surf, offs):
     ...
 
+def bounds(ent):
+    # The picture is "w" x "h" pixels (a tile by default) with its top-left
+    # corner at "x", "y"
+    attrs = ent.attributes
+    if "x" not in attrs or "y" not in attrs:
+        return None
+    return attrs["x"], attrs["y"], attrs.get("w", 32), attrs.get("h", 32)
+
 def update(ent):
     ...
 
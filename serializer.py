@@ -1,6 +1,18 @@
+import io
+import re
+import sys
+import array
 import struct
+import operator
+import tempfile
+import threading
 import warnings
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class Serializable():
     
     def __init__(self, name, *, exclude=[]):
@@ -15,16 +27,136 @@ class Serializable():
             raise AttributeError("__init_deserialize__ missing")
         
         FIELD_SERIALIZABLES.append(self)
+        _SERIALIZABLES_BY_NAME.setdefault(self.name, self)
         
         self.cls = cls
+        self._compile()
+        _ENCODERS[cls] = self.encode
         return cls
 
+    def _compile(self):
+        # Field order is fixed at decoration time, so everything but the field
+        # values themselves can be encoded once up front. The wire format is
+        # still the generic "O" name + dict of fields.
+        self.fields = [i for i in self.cls.__slots__ if i not in self.exclude]
+        if len(self.fields) == 1:
+            field = self.fields[0]
+            self._get_fields = lambda obj: (getattr(obj, field),)
+        else:
+            self._get_fields = operator.attrgetter(*self.fields)
+
+        prefix = bytearray(b"O")
+        _encode_str(self.name, prefix)
+        self._prefix = bytes(prefix)
+
+        dict_header = bytearray(b"D")
+        _encode_int(len(self.fields), dict_header)
+        self._dict_header = bytes(dict_header)
+
+        self._keys = []
+        for field in self.fields:
+            key = bytearray()
+            _encode_str(field, key)
+            self._keys.append(bytes(key))
+        # (string table, keys as "r" references into it), see _interned_keys
+        self._interned = None, None
+
+    def encode(self, obj, out):
+        if _session.strings is not None:
+            # Names are going into the string table, can't use the
+            # pre-encoded ones
+            out += b"O"
+            _encode_str(self.name, out)
+            out += self._dict_header
+            for field, value in zip(self.fields, self._get_fields(obj)):
+                _encode_str(field, out)
+                _encode(value, out)
+            return
+        out += self._prefix
+        out += self._dict_header
+        for key, value in zip(self._keys, self._get_fields(obj)):
+            out += key
+            _encode(value, out)
+
+    def decode(self, data, offs):
+        """Decodes the field dict of an "O" value (just past its name). Data
+written by encode() is read field by field in order; anything else (older
+field sets, reordered dicts) goes through the generic dict path."""
+        start = offs
+        if data[offs:offs+len(self._dict_header)] != self._dict_header:
+            return self._decode_generic(data, start)
+        offs += len(self._dict_header)
+        keys = self._keys if _session.table is None else self._interned_keys()
+        if keys is None:
+            return self._decode_generic(data, start)
+
+        res = self.cls.__new__(self.cls)
+        for field, key in zip(self.fields, keys):
+            if data[offs:offs+len(key)] != key:
+                return self._decode_generic(data, start)
+            value, offs = deserialize(data, offs + len(key))
+            setattr(res, field, value)
+
+        res.__init_deserialize__()
+        return res, offs
+
+    def decode_from(self, f):
+        """Streamed counterpart of decode(), for seekable files (it goes back
+to take the generic path)"""
+        start = f.tell()
+        keys = self._keys if _session.table is None else self._interned_keys()
+        if keys is not None and f.read(len(self._dict_header)) == self._dict_header:
+            res = self.cls.__new__(self.cls)
+            for field, key in zip(self.fields, keys):
+                if f.read(len(key)) != key:
+                    break
+                setattr(res, field, _decode_from(f))
+            else:
+                res.__init_deserialize__()
+                return res
+
+        f.seek(start)
+        objdict = _decode_from(f)
+        if type(objdict) is not dict:
+            raise ValueError("at offset %d: objdict must be dict" % _tell(f))
+        return _new_fields_object(self.name, objdict, _tell(f))
+
+    def _interned_keys(self):
+        # In interned data the keys are "r" references, which depend on the
+        # string table; they're worked out once per table (None if a field
+        # name isn't in it)
+        table, keys = self._interned
+        if table is not _session.table:
+            table = _session.table
+            index = {}
+            for i, string in enumerate(table):
+                index.setdefault(string, i)
+            keys = []
+            for field in self.fields:
+                if field not in index:
+                    keys = None
+                    break
+                key = bytearray(b"r")
+                _write_varint(index[field], key)
+                keys.append(bytes(key))
+            # One assignment, other threads may be decoding too
+            self._interned = table, keys
+        return keys
+
+    def _decode_generic(self, data, offs):
+        objdict, offs = deserialize(data, offs)
+        if type(objdict) is not dict:
+            raise ValueError("at offset %d: objdict must be dict" % offs)
+        return _new_fields_object(self.name, objdict, offs), offs
+
 def UserSerializable(name):
     def decorator(f):
         global USER_SERIALIZABLES
         nonlocal name
 
         USER_SERIALIZABLES[f] = name
+        _USER_CLASSES_BY_NAME.setdefault(name, f)
+        _ENCODERS[f] = _encode_user
         
         return f
 
@@ -32,213 +164,813 @@ def UserSerializable(name):
 
 FIELD_SERIALIZABLES = []
 USER_SERIALIZABLES = {}
-def serialize(obj):
-    if type(obj) is int:
-        # return b"i" + struct.pack("<i", obj)
-        if obj >= 0:
-            # Efficiently pack number
-            ilist = []
-            while obj > 0:
-                ilist.append(obj & 0b01111111)
-                obj >>= 7
-            if len(ilist) == 0:
-                ilist.append(0)
-                
-            return b"I" + bytes([i | 0b10000000 for i in ilist[:-1]] + [ilist[-1]])
+# Reverse lookups for decoding; the first class registered under a name wins
+_SERIALIZABLES_BY_NAME = {}
+_USER_CLASSES_BY_NAME = {}
+
+# Packed arrays ("A") are stored little-endian with a fixed item width, which
+# is written as one of "BHIQ" (unsigned) or "bhiq" (signed) for 1, 2, 4 and 8
+# byte items. Map those wire codes onto whatever typecodes this platform uses.
+_ARRAY_WIRE_CODES = {}
+_ARRAY_TYPECODES = {}
+for _tc in "bBhHiIlLqQ":
+    _wc = {1: "b", 2: "h", 4: "i", 8: "q"}[array.array(_tc).itemsize]
+    if _tc.isupper():
+        _wc = _wc.upper()
+    _ARRAY_WIRE_CODES[_tc] = ord(_wc)
+    _ARRAY_TYPECODES.setdefault(ord(_wc), _tc)
+del _tc, _wc
+
+def pack_ints(values):
+    """Packs a sequence of ints into the narrowest array that can hold them
+(u8/u16/u32 for tile ids, wider or signed only if needed)"""
+    lo = min(values, default=0)
+    hi = max(values, default=0)
+    for code in ("BHIQ" if lo >= 0 else "bhiq"):
+        typecode = _ARRAY_TYPECODES[ord(code)]
+        bits = 8 * array.array(typecode).itemsize
+        if lo >= 0 and hi < 1 << bits:
+            return array.array(typecode, values)
+        if lo < 0 and lo >= -(1 << (bits - 1)) and hi < 1 << (bits - 1):
+            return array.array(typecode, values)
+    raise ValueError("can't pack integers outside of the 64-bit range")
+
+def unpack_varints(data, offs, count):
+    """Decodes `count` untagged "I" varints starting at `offs` into an array
+of unsigned 64-bit ints"""
+    if numpy is not None:
+        return _unpack_varints_numpy(data, offs, count)
+
+    res = array.array(_ARRAY_TYPECODES[ord("Q")])
+    end = offs
+    while len(res) < count:
+        # Single byte varints are just their byte value, so whole runs of them
+        # can be copied over at once; only the longer ones need decoding
+        run = _SMALL_VARINTS.match(data, end, end + count - len(res))
+        if run:
+            res.extend(data[end:run.end()])
+            end = run.end()
         else:
-            return b"i" + struct.pack("i", obj)
+            v, end = _read_varint(data, end)
+            res.append(v)
+    return res, end
 
-    if type(obj) is float:
-        return b"f" + struct.pack("<f", obj)
+# Bytes without the continuation bit, i.e. complete single byte varints
+_SMALL_VARINTS = re.compile(b"[\\x00-\\x7f]+")
 
-    if type(obj) is str:
-        d = obj.encode("utf8")
-        return b"s" + serialize(len(d)) + d
+def _unpack_varints_numpy(data, offs, count):
+    res = array.array(_ARRAY_TYPECODES[ord("Q")])
+    if count == 0:
+        return res, offs
 
-    if type(obj) is bytes:
-        return b"b" + serialize(len(obj)) + obj
+    # A varint is at most 10 bytes long
+    window = numpy.frombuffer(data, numpy.uint8, max(0, min(len(data) - offs, count * 10)), offs)
+    ends = numpy.flatnonzero(window < 0x80)[:count]
+    if len(ends) < count:
+        raise IndexError("varint data truncated")
+    size = int(ends[-1]) + 1
+
+    if size == count:
+        values = window[:count].astype(numpy.uint64)
+    else:
+        # Shift each byte's low 7 bits by its position within its varint and
+        # sum them up per varint
+        window = window[:size]
+        starts = numpy.empty(count, numpy.intp)
+        starts[0] = 0
+        starts[1:] = ends[:-1] + 1
+        shifts = numpy.arange(size) - numpy.repeat(starts, ends - starts + 1)
+        groups = (window & 0x7f).astype(numpy.uint64) << (shifts * 7).astype(numpy.uint64)
+        values = numpy.add.reduceat(groups, starts)
+
+    res.frombytes(values.astype("<u8").tobytes())
+    if sys.byteorder == "big":
+        res.byteswap()
+    return res, offs + size
+
+def _read_varint(data, offs):
+    res = 0
+    shift = 0
+    while data[offs] & 0b10000000:
+        res |= (data[offs] & 0b01111111) << shift
+        shift += 7
+        offs += 1
+    res |= data[offs] << shift
+    return res, offs + 1
 
-    if obj is True:
-        return b"t"
+# Interned mode ("R" header): every string is written once, into a table at
+# the start of the data, and referred to as "r" + varint index everywhere else
+# (including inside UserSerializable payloads). The table comes first so any
+# section of the data can be decoded on its own once the table is known.
 
-    if obj is False:
-        return b"F"
+class _Session(threading.local):
+    # Tables of the interned encode/decode currently running on this thread
+    strings = None
+    table = None
 
-    if obj is None:
-        return b"N"
+_session = _Session()
 
-    if type(obj) in {list, set, tuple}:
-        if type(obj) is list:  res = b"L"
-        if type(obj) is tuple: res = b"T"
-        if type(obj) is set:   res = b"S"
-        res += serialize(len(obj))
-        for i in obj:
-            res += serialize(i)
-        return res
+class using_strings():
 
-    if type(obj) is dict:
-        res = b"D"
-        res += serialize(len(obj))
-        for k, v in obj.items():
-            res += serialize(k)
-            res += serialize(v)
-        return res
+    """Context manager making `table` (as returned by read_strings) the
+string table for "r" references decoded inside it"""
 
+    def __init__(self, table):
+        self.table = table
+
+    def __enter__(self):
+        self.prev = _session.table
+        _session.table = self.table
+
+    def __exit__(self, *exc):
+        _session.table = self.prev
+
+def read_strings(data, offs):
+    """If the value at `offs` has an "R" header, returns its string table
+and the offset of the value behind it, otherwise (None, offs)"""
+    if data[offs] != ord("R"):
+        return None, offs
+    table, offs = deserialize(data, offs + 1)
+    if type(table) is not list:
+        raise ValueError("at offset %d: string table must be list" % offs)
+    return table, offs
+
+def serialize(obj, intern=False):
+    """Encodes `obj`. With intern=True, repeated strings (type names, field
+names, tileset names...) are stored once in a string table."""
+    if not intern or _session.strings is not None:
+        # Nested calls (from dump()) use the running session, if any
+        out = bytearray()
+        _encode(obj, out)
+        return bytes(out)
+
+    _session.strings = {}
+    try:
+        body = bytearray()
+        _encode(obj, body)
+        strings = _session.strings
+    finally:
+        _session.strings = None
+
+    out = bytearray(b"R")
+    _encode_sequence(b"L")(list(strings), out)
+    out += body
+    return bytes(out)
+
+def _encode(obj, out):
+    # Everything is written into one shared bytearray, picking the encoder
+    # by exact type (subclasses of builtins are not serializable)
+    try:
+        encoder = _ENCODERS[type(obj)]
+    except KeyError:
+        encoder = _find_encoder(obj)
+    encoder(obj, out)
+
+def _find_encoder(obj):
     if type(obj) in USER_SERIALIZABLES:
-        res = b"U"
-        res += serialize(USER_SERIALIZABLES[type(obj)])
-        
-        raw = obj.dump()
-        res += serialize(len(raw))
-        res += raw
+        return _encode_user
 
-        return res
-    
     for entry in FIELD_SERIALIZABLES:
         if entry.cls is type(obj):
-            res = b"O"
-            res += serialize(entry.name)
-            d = {i: getattr(obj, i) for i in obj.__slots__ if i not in entry.exclude}
-            res += serialize(d)
-
-            return res
+            return entry.encode
 
     raise ValueError("can't serialize type %s" % type(obj).__name__)
 
+def _encode_int(obj, out):
+    # return b"i" + struct.pack("<i", obj)
+    if obj >= 0:
+        # Efficiently pack number
+        out.append(73) # "I"
+        while obj > 0b01111111:
+            out.append((obj & 0b01111111) | 0b10000000)
+            obj >>= 7
+        out.append(obj)
+    else:
+        out += b"i"
+        out += struct.pack("i", obj)
+
+def _write_varint(obj, out):
+    while obj > 0b01111111:
+        out.append((obj & 0b01111111) | 0b10000000)
+        obj >>= 7
+    out.append(obj)
+
+def _encode_float(obj, out):
+    out += b"f"
+    out += struct.pack("<f", obj)
+
+def _encode_str(obj, out):
+    if _session.strings is not None:
+        strings = _session.strings
+        index = strings.get(obj)
+        if index is None:
+            index = strings[obj] = len(strings)
+        out += b"r"
+        _write_varint(index, out)
+        return
+    d = obj.encode("utf8")
+    out += b"s"
+    _encode_int(len(d), out)
+    out += d
+
+def _encode_bytes(obj, out):
+    out += b"b"
+    _encode_int(len(obj), out)
+    out += obj
+
+def _encode_memoryview(obj, out):
+    out += b"b"
+    _encode_int(obj.nbytes, out)
+    out += obj
+
+def _encode_bool(obj, out):
+    out += b"t" if obj else b"F"
+
+def _encode_none(obj, out):
+    out += b"N"
+
+def _encode_sequence(tag):
+    def encoder(obj, out):
+        out += tag
+        _encode_int(len(obj), out)
+        for i in obj:
+            _encode(i, out)
+    return encoder
+
+def _encode_dict(obj, out):
+    out += b"D"
+    _encode_int(len(obj), out)
+    for k, v in obj.items():
+        _encode(k, out)
+        _encode(v, out)
+
+def _encode_array(obj, out):
+    if obj.typecode not in _ARRAY_WIRE_CODES:
+        raise ValueError("can't serialize array of type '%s'" % obj.typecode)
+    if sys.byteorder == "big":
+        obj = array.array(obj.typecode, obj)
+        obj.byteswap()
+    out += b"A"
+    out.append(_ARRAY_WIRE_CODES[obj.typecode])
+    _encode_int(len(obj), out)
+    out += obj.tobytes()
+
+def _encode_user(obj, out):
+    out += b"U"
+    _encode_str(USER_SERIALIZABLES[type(obj)], out)
+
+    raw = obj.dump()
+    _encode_int(len(raw), out)
+    out += raw
+
+_ENCODERS = {
+    int: _encode_int,
+    float: _encode_float,
+    str: _encode_str,
+    bytes: _encode_bytes,
+    memoryview: _encode_memoryview,
+    bool: _encode_bool,
+    type(None): _encode_none,
+    list: _encode_sequence(b"L"),
+    tuple: _encode_sequence(b"T"),
+    set: _encode_sequence(b"S"),
+    dict: _encode_dict,
+    array.array: _encode_array,
+}
 
-def deserialize(data, offs):
-    dtype = data[offs]
-    offs += 1
-    if dtype in b"I":
-        # sz = struct.calcsize("i")
-        # res = struct.unpack("i", data[offs:offs+sz])[0]
-        # offs += sz
-        ilist = []
-        while data[offs] & 0b10000000:
-            ilist.append(data[offs])
-            offs += 1
-        ilist.append(data[offs])
-        offs += 1
-
-        res = 0
-        for i, x in enumerate(ilist):
-            res |= (x & 0b01111111) << (7 * i)
-        
-        return res, offs
-
-    if dtype in b"i":
-        sz = struct.calcsize("i")
-        res = struct.unpack("i", data[offs:offs+sz])[0]
-        offs += sz
-
-        return res, offs
-
-    if dtype in b"f":
-        sz = struct.calcsize("f")
-        res = struct.unpack("f", data[offs:offs+sz])[0]
-        offs += sz
-        return res, offs
-
-    if dtype in b"sb":
-        sz, offs = deserialize(data, offs)
-        if type(sz) is not int:
-            raise ValueError("at offset %d: size must be int" % offs)
-        if sz < 0:
-            raise ValueError("at offset %d: size must be positive" % offs)
-
-        res = data[offs:offs+sz]
-        offs += sz
-
-        if dtype in b"s":
-            return res.decode("utf8"), offs
-        return res, offs
-
-    if dtype in b"t":
-        return True, offs
-
-    if dtype in b"F":
-        return False, offs
-
-    if dtype in b"N":
-        return None, offs
 
-    if dtype in b"LTS":
-        length, offs = deserialize(data, offs)
-        if type(length) is not int:
-            raise ValueError("at offset %d: length must be int" % offs)
-        if length < 0:
-            raise ValueError("at offset %d: length must be positive" % offs)
+def deserialize(data, offs):
+    """Decodes the value at `offs`, returning it and the offset just past it.
+`data` can be bytes or a memoryview; with a memoryview, the payloads handed
+to UserSerializable loaders are views, not copies. "b" blobs are always
+returned as bytes (see deserialize_blob)."""
+    try:
+        decoder = _DECODERS[data[offs]]
+    except KeyError:
+        raise ValueError("unknown type %d" % data[offs]) from None
+    return decoder(data, offs + 1)
+
+def _read_size(data, offs, what):
+    sz, offs = deserialize(data, offs)
+    if type(sz) is not int:
+        raise ValueError("at offset %d: %s must be int" % (offs, what))
+    if sz < 0:
+        raise ValueError("at offset %d: %s must be positive" % (offs, what))
+    return sz, offs
+
+def _decode_int(data, offs):
+    return struct.unpack_from("i", data, offs)[0], offs + struct.calcsize("i")
+
+def _decode_float(data, offs):
+    return struct.unpack_from("f", data, offs)[0], offs + struct.calcsize("f")
+
+def deserialize_blob(data, offs):
+    """Decodes the "b" blob at `offs` like deserialize(), but as a slice of
+`data`: a view into it when `data` is a memoryview. For UserSerializable
+loaders that are done with the blob before they return."""
+    if data[offs] != ord("b"):
+        raise ValueError("at offset %d: expected bytes" % offs)
+    sz, offs = _read_size(data, offs + 1, "size")
+    if offs + sz > len(data):
+        raise ValueError("at offset %d: bytes truncated" % offs)
+    return data[offs:offs+sz], offs + sz
+
+def _decode_bytes(data, offs):
+    # Copied even from a memoryview: a view would keep the whole buffer (or
+    # mmap) alive and doesn't behave like bytes
+    sz, offs = _read_size(data, offs, "size")
+    return bytes(data[offs:offs+sz]), offs + sz
+
+def _decode_str(data, offs):
+    sz, offs = _read_size(data, offs, "size")
+    return str(data[offs:offs+sz], "utf8"), offs + sz
+
+def _decode_constant(value):
+    def decoder(data, offs):
+        return value, offs
+    return decoder
+
+def _decode_sequence(result_type):
+    def decoder(data, offs):
+        length, offs = _read_size(data, offs, "length")
 
         res = []
-        for _ in range(length):
+        while len(res) < length:
+            if data[offs] == 73:  # "I"
+                # Runs of small ints (layer rows, attribute arrays) are
+                # "I" + one byte each, take all of them in one go
+                run = _SMALL_INTS.match(data, offs, offs + 2 * (length - len(res)))
+                if run:
+                    res.extend(data[offs+1:run.end():2])
+                    offs = run.end()
+                    continue
             element, offs = deserialize(data, offs)
             res.append(element)
 
-        if dtype in b"T":
-            return tuple(res), offs
-        if dtype in b"S":
-            return set(res), offs
-        return res, offs
+        if result_type is list:
+            return res, offs
+        return result_type(res), offs
+    return decoder
 
-    if dtype in b"D":
-        length, offs = deserialize(data, offs)
-        if type(length) is not int:
-            raise ValueError("at offset %d: length must be int" % offs)
-        if length < 0:
-            raise ValueError("at offset %d: length must be positive" % offs)
-
-        res = {}
-        for _ in range(length):
-            key, offs = deserialize(data, offs)
-            value, offs = deserialize(data, offs)
-            if type(key) is list:
-                warnings.warn(UserWarning("key is list, coercing into tuple"))
-                key = tuple(key)
-            res[key] = value
-        return res, offs
+_SMALL_INTS = re.compile(b"(?:I[\\x00-\\x7f])+")
 
-    if dtype in b"O":
-        objname, offs = deserialize(data, offs)
-        if type(objname) is not str:
-            raise ValueError("at offset %d: objname must be str" % offs)
+def _decode_dict(data, offs):
+    length, offs = _read_size(data, offs, "length")
 
-        objdict, offs = deserialize(data, offs)
-        if type(objdict) is not dict:
-            raise ValueError("at offset %d: objdict must be dict" % offs)
+    res = {}
+    for _ in range(length):
+        key, offs = deserialize(data, offs)
+        value, offs = deserialize(data, offs)
+        if type(key) is list:
+            warnings.warn(UserWarning("key is list, coercing into tuple"))
+            key = tuple(key)
+        res[key] = value
+    return res, offs
 
+def _decode_array(data, offs):
+    wire_code = data[offs]
+    offs += 1
+    if wire_code not in _ARRAY_TYPECODES:
+        raise ValueError("at offset %d: unknown array type %d" % (offs, wire_code))
+    length, offs = _read_size(data, offs, "length")
+
+    res = array.array(_ARRAY_TYPECODES[wire_code])
+    sz = length * res.itemsize
+    if offs + sz > len(data):
+        raise ValueError("at offset %d: array data truncated" % offs)
+    res.frombytes(data[offs:offs+sz])
+    if sys.byteorder == "big":
+        res.byteswap()
+    return res, offs + sz
+
+def _decode_fields(data, offs):
+    objname, offs = deserialize(data, offs)
+    if type(objname) is not str:
+        raise ValueError("at offset %d: objname must be str" % offs)
+
+    entry = _SERIALIZABLES_BY_NAME.get(objname)
+    if entry is not None:
+        return entry.decode(data, offs)
+
+    objdict, offs = deserialize(data, offs)
+    if type(objdict) is not dict:
+        raise ValueError("at offset %d: objdict must be dict" % offs)
+
+    return _new_fields_object(objname, objdict, offs), offs
+
+def _new_fields_object(objname, objdict, offs):
+    entry = _SERIALIZABLES_BY_NAME.get(objname)
+    if entry is None:
         for entry in FIELD_SERIALIZABLES:
             if entry.name == objname:
                 break
         else:
             raise ValueError("at offset %d: unknown Serializable \"%s\"" % (offs, objname))
 
-        res = entry.cls.__new__(entry.cls)
-        for key in objdict:
-            if type(key) is not str:
-                raise ValueError("at offset %d: object attribute name must be str" % (offs))
-            setattr(res, key, objdict[key])
+    res = entry.cls.__new__(entry.cls)
+    for key in objdict:
+        if type(key) is not str:
+            raise ValueError("at offset %d: object attribute name must be str" % (offs))
+        setattr(res, key, objdict[key])
 
-        res.__init_deserialize__()
-        
-        return res, offs
+    res.__init_deserialize__()
+    
+    return res
+
+def _decode_user(data, offs):
+    objname, offs = deserialize(data, offs)
+    if type(objname) is not str:
+        raise ValueError("at offset %d: objname must be str" % offs)
+
+    sz, offs = _read_size(data, offs, "size")
+
+    return _find_user_class(objname, offs).load(data[offs:offs+sz]), offs + sz
+
+def _find_user_class(objname, offs):
+    if objname in _USER_CLASSES_BY_NAME:
+        return _USER_CLASSES_BY_NAME[objname]
+    for key in USER_SERIALIZABLES:
+        if USER_SERIALIZABLES[key] == objname:
+            return key
+    raise ValueError("at offset %d: unknown UserSerializable \"%s\"" % (offs, objname))
+
+def _decode_interned(data, offs):
+    table, offs = read_strings(data, offs - 1)
+    with using_strings(table):
+        return deserialize(data, offs)
+
+def _decode_reference(data, offs):
+    index, offs = _read_varint(data, offs)
+    return _lookup_string(index, offs), offs
+
+def _lookup_string(index, offs):
+    if _session.table is None:
+        raise ValueError("at offset %d: string reference outside of interned data" % offs)
+    if index >= len(_session.table):
+        raise ValueError("at offset %d: string reference %d out of range" % (offs, index))
+    return _session.table[index]
+
+_DECODERS = {
+    ord("I"): _read_varint,
+    ord("i"): _decode_int,
+    ord("f"): _decode_float,
+    ord("s"): _decode_str,
+    ord("b"): _decode_bytes,
+    ord("t"): _decode_constant(True),
+    ord("F"): _decode_constant(False),
+    ord("N"): _decode_constant(None),
+    ord("L"): _decode_sequence(list),
+    ord("T"): _decode_sequence(tuple),
+    ord("S"): _decode_sequence(set),
+    ord("D"): _decode_dict,
+    ord("A"): _decode_array,
+    ord("O"): _decode_fields,
+    ord("U"): _decode_user,
+    ord("R"): _decode_interned,
+    ord("r"): _decode_reference,
+}
+
+
+# Walking over encoded values without decoding them, for lazy loading
+
+def skip(data, offs):
+    """Returns the offset just past the value at `offs`, without decoding it.
+Blobs, strings, arrays and UserSerializable payloads are skipped using their
+size prefix, so this is cheap for everything but deeply nested containers."""
+    try:
+        skipper = _SKIPPERS[data[offs]]
+    except KeyError:
+        raise ValueError("unknown type %d" % data[offs]) from None
+    return skipper(data, offs + 1)
+
+def user_payload(data, offs):
+    """Reads the header of the UserSerializable value at `offs`, returning
+its registered name and the start and end offsets of its payload"""
+    if data[offs] != ord("U"):
+        raise ValueError("at offset %d: expected UserSerializable" % offs)
+    objname, offs = deserialize(data, offs + 1)
+    if type(objname) is not str:
+        raise ValueError("at offset %d: objname must be str" % offs)
+    sz, offs = _read_size(data, offs, "size")
+    if offs + sz > len(data):
+        raise ValueError("at offset %d: payload truncated" % offs)
+    return objname, offs, offs + sz
+
+def _skip_fixed(size):
+    def skipper(data, offs):
+        return offs + size
+    return skipper
+
+def _skip_varint(data, offs):
+    while data[offs] & 0b10000000:
+        offs += 1
+    return offs + 1
+
+def _skip_sized(data, offs):
+    sz, offs = _read_size(data, offs, "size")
+    return offs + sz
+
+def _skip_sequence(data, offs):
+    length, offs = _read_size(data, offs, "length")
+    for _ in range(length):
+        offs = skip(data, offs)
+    return offs
+
+def _skip_dict(data, offs):
+    length, offs = _read_size(data, offs, "length")
+    for _ in range(2 * length):
+        offs = skip(data, offs)
+    return offs
+
+def _skip_array(data, offs):
+    wire_code = data[offs]
+    if wire_code not in _ARRAY_TYPECODES:
+        raise ValueError("at offset %d: unknown array type %d" % (offs, wire_code))
+    length, offs = _read_size(data, offs + 1, "length")
+    return offs + length * array.array(_ARRAY_TYPECODES[wire_code]).itemsize
+
+def _skip_fields(data, offs):
+    # Also used for "R", which is likewise followed by two values
+    return skip(data, skip(data, offs))
+
+def _skip_user(data, offs):
+    return _skip_sized(data, skip(data, offs))
+
+_SKIPPERS = {
+    ord("I"): _skip_varint,
+    ord("i"): _skip_fixed(struct.calcsize("i")),
+    ord("f"): _skip_fixed(struct.calcsize("f")),
+    ord("s"): _skip_sized,
+    ord("b"): _skip_sized,
+    ord("t"): _skip_fixed(0),
+    ord("F"): _skip_fixed(0),
+    ord("N"): _skip_fixed(0),
+    ord("L"): _skip_sequence,
+    ord("T"): _skip_sequence,
+    ord("S"): _skip_sequence,
+    ord("D"): _skip_dict,
+    ord("A"): _skip_array,
+    ord("O"): _skip_fields,
+    ord("U"): _skip_user,
+    ord("R"): _skip_fields,
+    ord("r"): _skip_varint,
+}
+
+
+# Streaming versions of serialize()/deserialize(), working on binary files.
+# Containers are written and read element by element, and UserSerializables
+# can stream their payload by defining dump_to(f) and load_from(f, size)
+# alongside dump() and load(), so memory use is bounded by the largest single
+# value rather than by the whole file.
+
+_FLUSH_SIZE = 1 << 16
+# Sizes of streamed payloads are patched in afterwards, so they're written as
+# a varint padded to a fixed width (still readable by _read_varint)
+_PADDED_SIZE_WIDTH = 5
+
+def serialize_to(obj, f, intern=False):
+    if not intern or _session.strings is not None:
+        out = bytearray()
+        _encode_to(obj, out, f)
+        f.write(out)
+        return
+
+    # The string table has to come first, so the body is spooled to a
+    # temporary file while the table is being built
+    with tempfile.TemporaryFile() as body:
+        _session.strings = {}
+        try:
+            out = bytearray()
+            _encode_to(obj, out, body)
+            body.write(out)
+            strings = _session.strings
+        finally:
+            _session.strings = None
+
+        out = bytearray(b"R")
+        _encode_sequence(b"L")(list(strings), out)
+        f.write(out)
+        body.seek(0)
+        while True:
+            chunk = body.read(_FLUSH_SIZE)
+            if not chunk:
+                break
+            f.write(chunk)
 
-    if dtype in b"U":
-        objname, offs = deserialize(data, offs)
-        if type(objname) is not str:
-            raise ValueError("at offset %d: objname must be str" % offs)
+def _encode_to(obj, out, f):
+    if type(obj) in _STREAM_SEQUENCE_TAGS:
+        out += _STREAM_SEQUENCE_TAGS[type(obj)]
+        _encode_int(len(obj), out)
+        for i in obj:
+            _encode_to(i, out, f)
 
-        sz, offs = deserialize(data, offs)
-        if type(sz) is not int:
-            raise ValueError("at offset %d: size must be int" % offs)
-        if sz < 0:
-            raise ValueError("at offset %d: size must be positive" % offs)
+    elif type(obj) is dict:
+        out += b"D"
+        _encode_int(len(obj), out)
+        for k, v in obj.items():
+            _encode_to(k, out, f)
+            _encode_to(v, out, f)
+
+    elif type(obj) in USER_SERIALIZABLES and hasattr(obj, "dump_to"):
+        _encode_user_to(obj, out, f)
+
+    else:
+        _encode(obj, out)
+
+    if len(out) >= _FLUSH_SIZE:
+        f.write(out)
+        out.clear()
+
+def _encode_user_to(obj, out, f):
+    out += b"U"
+    _encode_str(USER_SERIALIZABLES[type(obj)], out)
+
+    if not f.seekable():
+        buf = io.BytesIO()
+        obj.dump_to(buf)
+        _encode_int(buf.tell(), out)
+        out += buf.getbuffer()
+        return
+
+    out += b"I"
+    f.write(out)
+    out.clear()
+    start = f.tell()
+    f.write(bytes(_PADDED_SIZE_WIDTH))
+    obj.dump_to(f)
+    end = f.tell()
+
+    size = end - start - _PADDED_SIZE_WIDTH
+    if size >> (7 * _PADDED_SIZE_WIDTH):
+        raise ValueError("payload of %s too large to stream" % type(obj).__name__)
+    padded = bytearray()
+    for i in range(_PADDED_SIZE_WIDTH - 1):
+        padded.append(((size >> (7 * i)) & 0b01111111) | 0b10000000)
+    padded.append(size >> (7 * (_PADDED_SIZE_WIDTH - 1)))
+    f.seek(start)
+    f.write(padded)
+    f.seek(end)
+
+_STREAM_SEQUENCE_TAGS = {list: b"L", tuple: b"T", set: b"S"}
+
+
+def deserialize_from(f):
+    """Reads one value from the binary file `f`; raises EOFError if `f` is
+already at its end"""
+    tag = f.read(1)
+    if not tag:
+        raise EOFError("no more data")
+    return _decode_tag_from(tag[0], f)
+
+def _decode_from(f):
+    tag = f.read(1)
+    if not tag:
+        raise ValueError("unexpected end of data")
+    return _decode_tag_from(tag[0], f)
+
+def _decode_tag_from(dtype, f):
+    try:
+        decoder = _STREAM_DECODERS[dtype]
+    except KeyError:
+        raise ValueError("unknown type %d" % dtype) from None
+    return decoder(f)
+
+def _read_exact(f, n):
+    res = f.read(n)
+    if len(res) != n:
+        raise ValueError("unexpected end of data")
+    return res
+
+def _tell(f):
+    return f.tell() if f.seekable() else -1
+
+def _read_size_from(f, what):
+    sz = _decode_from(f)
+    if type(sz) is not int:
+        raise ValueError("at offset %d: %s must be int" % (_tell(f), what))
+    if sz < 0:
+        raise ValueError("at offset %d: %s must be positive" % (_tell(f), what))
+    return sz
+
+def _stream_decoder(decoder, size):
+    # Fixed-size values are just read in one go and decoded from memory
+    def stream_decoder(f):
+        return decoder(_read_exact(f, size), 0)[0]
+    return stream_decoder
+
+def _decode_varint_from(f):
+    res = 0
+    shift = 0
+    while True:
+        b = _read_exact(f, 1)[0]
+        res |= (b & 0b01111111) << shift
+        if not b & 0b10000000:
+            return res
+        shift += 7
 
-        for key in USER_SERIALIZABLES:
-            if USER_SERIALIZABLES[key] == objname:
-                break
-        else:
-            raise ValueError("at offset %d: unknown UserSerializable \"%s\"" % (offs, objname))
+def _decode_bytes_from(f):
+    return _read_exact(f, _read_size_from(f, "size"))
 
-        return key.load(data[offs:offs+sz]), offs + sz
+def _decode_str_from(f):
+    return str(_read_exact(f, _read_size_from(f, "size")), "utf8")
+
+def _decode_constant_from(value):
+    def decoder(f):
+        return value
+    return decoder
+
+def _decode_sequence_from(result_type):
+    def decoder(f):
+        length = _read_size_from(f, "length")
+        res = [_decode_from(f) for _ in range(length)]
+        if result_type is list:
+            return res
+        return result_type(res)
+    return decoder
+
+def _decode_dict_from(f):
+    length = _read_size_from(f, "length")
+
+    res = {}
+    for _ in range(length):
+        key = _decode_from(f)
+        value = _decode_from(f)
+        if type(key) is list:
+            warnings.warn(UserWarning("key is list, coercing into tuple"))
+            key = tuple(key)
+        res[key] = value
+    return res
+
+def _decode_array_from(f):
+    wire_code = _read_exact(f, 1)[0]
+    if wire_code not in _ARRAY_TYPECODES:
+        raise ValueError("at offset %d: unknown array type %d" % (_tell(f), wire_code))
+    length = _read_size_from(f, "length")
+
+    res = array.array(_ARRAY_TYPECODES[wire_code])
+    res.frombytes(_read_exact(f, length * res.itemsize))
+    if sys.byteorder == "big":
+        res.byteswap()
+    return res
+
+def _decode_fields_from(f):
+    objname = _decode_from(f)
+    if type(objname) is not str:
+        raise ValueError("at offset %d: objname must be str" % _tell(f))
+
+    entry = _SERIALIZABLES_BY_NAME.get(objname)
+    if entry is not None and f.seekable():
+        return entry.decode_from(f)
+
+    objdict = _decode_from(f)
+    if type(objdict) is not dict:
+        raise ValueError("at offset %d: objdict must be dict" % _tell(f))
+
+    return _new_fields_object(objname, objdict, _tell(f))
+
+def _decode_user_from(f):
+    objname = _decode_from(f)
+    if type(objname) is not str:
+        raise ValueError("at offset %d: objname must be str" % _tell(f))
+
+    sz = _read_size_from(f, "size")
+    cls = _find_user_class(objname, _tell(f))
+
+    if hasattr(cls, "load_from") and f.seekable():
+        end = f.tell() + sz
+        res = cls.load_from(f, sz)
+        if f.tell() != end:
+            raise ValueError("at offset %d: \"%s\" payload size mismatch" % (f.tell(), objname))
+        return res
 
-    raise ValueError("unknown type %d" % dtype)
+    return cls.load(memoryview(_read_exact(f, sz)))
+
+def _decode_interned_from(f):
+    table = _decode_from(f)
+    if type(table) is not list:
+        raise ValueError("at offset %d: string table must be list" % _tell(f))
+    with using_strings(table):
+        return _decode_from(f)
+
+def _decode_reference_from(f):
+    return _lookup_string(_decode_varint_from(f), _tell(f))
+
+_STREAM_DECODERS = {
+    ord("I"): _decode_varint_from,
+    ord("i"): _stream_decoder(_decode_int, struct.calcsize("i")),
+    ord("f"): _stream_decoder(_decode_float, struct.calcsize("f")),
+    ord("s"): _decode_str_from,
+    ord("b"): _decode_bytes_from,
+    ord("t"): _decode_constant_from(True),
+    ord("F"): _decode_constant_from(False),
+    ord("N"): _decode_constant_from(None),
+    ord("L"): _decode_sequence_from(list),
+    ord("T"): _decode_sequence_from(tuple),
+    ord("S"): _decode_sequence_from(set),
+    ord("D"): _decode_dict_from,
+    ord("A"): _decode_array_from,
+    ord("O"): _decode_fields_from,
+    ord("U"): _decode_user_from,
+    ord("R"): _decode_interned_from,
+    ord("r"): _decode_reference_from,
+}
@@ -0,0 +1,483 @@
+import os
+import pytest
+from conftest import ROOT
+import game_types
+from game_types import *
+from leveltool import same_map
+
+class FakeImage():
+
+    # One "pixel" per tile: what was drawn there, bottom first. Pixels that
+    # start with "#" are opaque, blitting one replaces what was under it.
+    # Blending onto a see-through pixel isn't the same as blending onto
+    # each thing under it in turn, so that gives a pixel starting with "~".
+
+    def __init__(self, w, h, pixels=None):
+        self.w, self.h = w, h
+        self.pixels = pixels or {}
+
+class FakeContext():
+
+    """Just enough of a Context to draw layers. The tileset image has tile i
+opaque, see-through or empty as TILES[i] is "#", "~" or " "."""
+
+    TILES = "#~ ##~#~"
+
+    def load_image(self, path):
+        pixels = {(i, 0): ("#", i) if kind == "#" else (i,) for i, kind in enumerate(self.TILES) if kind != " "}
+        return FakeImage(len(self.TILES) * TILESIZE[0], TILESIZE[1], pixels)
+
+    def empty_image(self, w, h, alpha=True):
+        return FakeImage(w, h)
+
+    def alpha_coverage(self, image, bbox):
+        pixel = image.pixels.get((bbox[0] // TILESIZE[0], bbox[1] // TILESIZE[1]), ())
+        area = TILESIZE[0] * TILESIZE[1]
+        return (area if pixel else 0), (area if pixel[:1] == ("#",) else 0)
+
+    def fill_image(self, image, color, rect=None):
+        x, y, w, h = rect[0] + rect[1] if rect is not None else (0, 0, image.w, image.h)
+        for cell in list(image.pixels):
+            if x <= cell[0] * TILESIZE[0] < x + w and y <= cell[1] * TILESIZE[1] < y + h:
+                del image.pixels[cell]
+
+    def blit(self, dst, src, loc, bbox=None):
+        x0, y0, w, h = bbox or (0, 0, src.w, src.h)
+        for (x, y), pixel in src.pixels.items():
+            x, y = x * TILESIZE[0] - x0, y * TILESIZE[1] - y0
+            if not (0 <= x < w and 0 <= y < h):
+                continue
+            x, y = x + loc[0], y + loc[1]
+            if 0 <= x < dst.w and 0 <= y < dst.h:
+                cell = x // TILESIZE[0], y // TILESIZE[1]
+                under = dst.pixels.get(cell, ())
+                if pixel[0] == "#" or not under:
+                    dst.pixels[cell] = pixel
+                elif under[0] == "#":
+                    dst.pixels[cell] = under + pixel
+                else:
+                    dst.pixels[cell] = ("~",) + under + pixel
+
+    def blit_many(self, dst, blits):
+        for src, loc, bbox in blits:
+            self.blit(dst, src, loc, bbox)
+
+def use_fake_context(level, tmp_path):
+    # The tileset isn't in TILESET_DIR, so every test gets its own
+    ctx = FakeContext()
+    tileset = Tileset(ctx, str(tmp_path / "fake.png"), "fake")
+    for layer in level.layers:
+        layer.set_ctx(ctx)
+        layer.tileset = tileset
+    return tileset
+
+def backdrop(layers):
+    # Opaque image the size of the biggest layer
+    width = max(layer.width for layer in layers)
+    height = max(layer.height for layer in layers)
+    pixels = {(x, y): ("#", "backdrop") for y in range(height) for x in range(width)}
+    return FakeImage(width * TILESIZE[0], height * TILESIZE[1], pixels)
+
+def render(layers, t=0.0):
+    # What drawing `layers` one tile at a time looks like, without any caches
+    tileset = layers[0].tileset
+    image = backdrop(layers)
+    for layer in layers:
+        for y, row in enumerate(layer):
+            for x, tile in enumerate(row):
+                source = tileset.source(tileset.frame(int(tile), t))
+                if source is not None:
+                    tileset.ctx.blit(image, source[0], (x * TILESIZE[0], y * TILESIZE[1]), source[1])
+    return image.pixels
+
+def draw(level):
+    # What Map.draw() shows of all of the level
+    image = backdrop(level.layers)
+    level.draw(image, (0, 0))
+    return image.pixels
+
+def test_close_lazy_level_with_bytes_attribute(tmp_path):
+    filename = str(tmp_path / "level0")
+    level = Map([TileLayer("blue", [[1, 2], [3, 4]])], set())
+    level.entities.add(Entity("sign", {"data": b"\x00\x01\x02"}, "picture", level))
+    write_level(filename, level)
+
+    lazy = open_level(filename, lazy=True)
+    entity, = lazy.entities
+    assert entity.attributes["data"] == b"\x00\x01\x02"
+    assert list(map(list, lazy.layers[0])) == [[1, 2], [3, 4]]
+    lazy.close()
+    # Still usable after the file is gone
+    assert entity.attributes["data"].decode("latin1") == "\x00\x01\x02"
+
+def test_array_storage_dumps_like_lists(monkeypatch):
+    pytest.importorskip("numpy")
+    rows = [[(x * 7 + y) % 300 for x in range(40)] for y in range(30)]
+    rows[3] = [5] * 40
+    for compression in (None, "zlib"):
+        monkeypatch.setattr(TileLayer, "compression", compression)
+        monkeypatch.setattr(TileLayer, "storage", "numpy")
+        array_layer = TileLayer("blue", rows)
+        monkeypatch.setattr(TileLayer, "storage", "list")
+        list_layer = TileLayer("blue", rows)
+        assert array_layer._is_array() and not list_layer._is_array()
+        assert array_layer.dump() == list_layer.dump()
+
+def test_sparse_layers_honor_compression(monkeypatch):
+    rows = [[0] * 200 for y in range(100)]
+    for i in range(40):
+        rows[i * 2][i * 5] = 3
+    plain = TileLayer("blue", rows).dump()
+    assert plain[:1] == b"S"
+    for compression in ("zlib", "lzma"):
+        monkeypatch.setattr(TileLayer, "compression", compression)
+        layer = TileLayer("blue", rows)
+        assert layer._is_sparse()
+        data = layer.dump()
+        assert data[:1] == b"Z"
+        again = TileLayer.load(memoryview(data))
+        assert again._is_sparse() and list(map(list, again)) == rows
+
+@pytest.mark.parametrize("storage", ["numpy", "sparse"])
+def test_layer_rows_read_like_lists(monkeypatch, storage):
+    if storage == "numpy":
+        pytest.importorskip("numpy")
+        monkeypatch.setattr(TileLayer, "storage", "numpy")
+        monkeypatch.setattr(TileLayer, "sparse_density", None)
+    rows = [[0] * 40 for _ in range(30)]
+    rows[2][:3] = [4, 5, 6]
+    layer = TileLayer("blue", rows)
+    assert layer._is_array() if storage == "numpy" else layer._is_sparse()
+
+    assert type(layer[2][1]) is int and serialize(layer[2][1]) == serialize(5)
+    assert layer[2] == rows[2] and rows[2] == layer[2] and layer[3] != rows[2]
+    assert layer[2][:3] == [4, 5, 6] and layer[-28][-40] == 4
+    assert [list(row) for row in layer] == rows and layer[1:3] == rows[1:3]
+    assert all(type(tile) is int for row in layer for tile in row)
+    with pytest.raises(IndexError):
+        layer[30]
+    layer[2][0] = 9
+    assert layer[2][0] == 9
+
+def test_entities_outside_of_the_view_are_skipped(monkeypatch):
+    drawn = []
+    level = Map([], set())
+    for name, x in (("near", 10), ("far", 5000)):
+        level.entities.add(Entity(name, {"x": x, "y": 10}, "picture", level))
+    script = next(iter(level.entities)).script
+    monkeypatch.setattr(script, "draw", lambda ent, surface, offset: drawn.append(ent.name), raising=False)
+    level.draw(None, (0, 0), (0, 0, 800, 600))
+    assert drawn == ["near"]
+
+@pytest.mark.parametrize("name", ["level0", "level1", "level2"])
+def test_bundled_levels_round_trip(name, tmp_path):
+    level = open_level(os.path.join(ROOT, name))
+    assert isinstance(level, Map) and all(isinstance(layer, TileLayer) for layer in level.layers)
+    for intern in (False, True):
+        again = deserialize(memoryview(serialize(level, intern=intern)), 0)[0]
+        assert same_map(level, again)
+    write_level(str(tmp_path / name), level)
+    assert same_map(level, open_level(str(tmp_path / name)))
+    assert same_map(level, open_level(str(tmp_path / name), lazy=True))
+
+def make_journaled_level(tmp_path, tile=1):
+    filename = str(tmp_path / "level0")
+    write_level(filename, Map([TileLayer("blue", [[tile] * 8 for _ in range(6)])], set()))
+    level = open_level(filename)
+    return level, LevelJournal(filename, level)
+
+def test_failed_compaction_is_retried(tmp_path, monkeypatch):
+    monkeypatch.setattr(TileLayer, "BULK_CELLS", 16)
+    level, journal = make_journaled_level(tmp_path)
+    level.layers[0].fill_region(0, 0, 8, 6, 7)
+
+    def fail(filename, map):
+        raise OSError("disk full")
+    real_write_level = write_level
+    monkeypatch.setattr(game_types, "write_level", fail)
+    with pytest.raises(OSError):
+        journal.save()
+    monkeypatch.setattr(game_types, "write_level", real_write_level)
+
+    assert journal.needs_compaction()
+    journal.save()
+    assert open_level(journal.filename).layers[0][5][7] == 7
+
+class Crash(Exception):
+    pass
+
+def test_journals_already_in_the_level_file_are_skipped(tmp_path, monkeypatch):
+    monkeypatch.setattr(TileLayer, "BULK_CELLS", 16)
+    level, journal = make_journaled_level(tmp_path)
+    level.layers[0].set_cell(0, 0, 5)
+    journal.save()
+    level.layers[0].fill_region(0, 0, 8, 6, 7)
+
+    # Crash right after the level file is written, before the journal that
+    # came before the fill is deleted
+    def crash(filename):
+        raise Crash()
+    monkeypatch.setattr(os, "remove", crash)
+    with pytest.raises(Crash):
+        journal.save()
+    monkeypatch.undo()
+
+    level = open_level(journal.filename)
+    journal = LevelJournal(journal.filename, level)
+    assert journal.replay() == 0
+    assert list(map(list, level.layers[0])) == [[7] * 8] * 6
+    assert not journal.needs_compaction()
+
+def test_journals_after_an_unfinished_rewrite_are_skipped(tmp_path, monkeypatch):
+    monkeypatch.setattr(TileLayer, "BULK_CELLS", 16)
+    level, journal = make_journaled_level(tmp_path)
+    level.layers[0].set_cell(0, 0, 5)
+    journal.save()
+    level.layers[0].fill_region(0, 0, 8, 6, 7)
+    # Crash while the level file is being written; edits saved meanwhile went
+    # to the new journal
+    journal.prepare_compaction()
+    level.layers[0].set_cell(1, 1, 3)
+    journal.save()
+
+    level = open_level(journal.filename)
+    journal = LevelJournal(journal.filename, level)
+    assert journal.replay() == 1
+    expected = [[1] * 8 for _ in range(6)]
+    expected[0][0] = 5
+    assert list(map(list, level.layers[0])) == expected
+    assert journal.needs_compaction()
+    journal.save()
+    assert journal._moved_journals() == [] and not os.path.exists(journal.journal_filename)
+    assert list(map(list, open_level(journal.filename).layers[0])) == expected
+
+def reopen(journal):
+    level = open_level(journal.filename)
+    journal = LevelJournal(journal.filename, level)
+    return level, journal, journal.replay()
+
+def test_journal_appends_and_replays(tmp_path):
+    level, journal = make_journaled_level(tmp_path)
+    level.layers[0].set_cell(1, 2, 5)
+    level.layers[0].set_cell(7, 5, 6)
+    assert not journal.needs_compaction()
+    journal.save()
+    level.layers[0].set_cell(1, 2, 3)
+    journal.save()
+    assert os.path.exists(journal.journal_filename)
+    assert open_level(journal.filename).layers[0][2][1] == 1
+
+    level, journal, count = reopen(journal)
+    assert count == 2
+    assert level.layers[0][2][1] == 3 and level.layers[0][5][7] == 6
+
+def test_journal_drops_a_torn_last_record(tmp_path):
+    level, journal = make_journaled_level(tmp_path)
+    level.layers[0].set_cell(0, 0, 5)
+    journal.save()
+    size = os.path.getsize(journal.journal_filename)
+    level.layers[0].set_cell(0, 1, 6)
+    journal.save()
+    with open(journal.journal_filename, "r+b") as f:
+        f.truncate(os.path.getsize(journal.journal_filename) - 1)
+
+    with pytest.warns(UserWarning):
+        level, journal, count = reopen(journal)
+    assert count == 1
+    assert level.layers[0][0][0] == 5 and level.layers[0][1][0] == 1
+    assert os.path.getsize(journal.journal_filename) == size
+    # Later saves go after the last good record
+    level.layers[0].set_cell(0, 2, 7)
+    journal.save()
+    level, journal, count = reopen(journal)
+    assert count == 2 and level.layers[0][2][0] == 7
+
+def test_journal_rewrites_the_level_after_a_resize(tmp_path):
+    level, journal = make_journaled_level(tmp_path)
+    level.layers[0].set_cell(0, 0, 5)
+    journal.save()
+    level.layers[0].resize(4, 3)
+    assert journal.needs_compaction()
+    journal.save()
+    assert not os.path.exists(journal.journal_filename) and journal._moved_journals() == []
+    saved = open_level(journal.filename).layers[0]
+    assert (saved.width, saved.height) == (4, 3) and saved[0][0] == 5
+
+def test_journal_is_compacted_once_it_grows(tmp_path, monkeypatch):
+    monkeypatch.setattr(LevelJournal, "COMPACT_RECORDS", 2)
+    level, journal = make_journaled_level(tmp_path)
+    for x in range(3):
+        level.layers[0].set_cell(x, 0, 5)
+        journal.save()
+        assert os.path.exists(journal.journal_filename) == (x < 2)
+    assert open_level(journal.filename).layers[0][0][:4] == [5, 5, 5, 1]
+    level, journal, count = reopen(journal)
+    assert count == 0
+
+def test_journal_compacts_in_the_background(tmp_path, monkeypatch):
+    monkeypatch.setattr(LevelJournal, "COMPACT_RECORDS", 1)
+    level, journal = make_journaled_level(tmp_path)
+    level.layers[0].set_cell(0, 0, 5)
+    journal.save()
+    pending = []
+    def submit(function, *args):
+        pending.append((function, args))
+        return "future"
+    level.layers[0].set_cell(1, 0, 6)
+    assert journal.save(submit) == "future"
+    # Editing goes on while the level file is written
+    level.layers[0].set_cell(2, 0, 7)
+    journal.save()
+    assert reopen(journal)[0].layers[0][0][:3] == [5, 6, 7]
+
+    function, args = pending.pop()
+    function(*args)
+    assert open_level(journal.filename).layers[0][0][:3] == [5, 6, 1]
+    assert reopen(journal)[0].layers[0][0][:3] == [5, 6, 7]
+
+@pytest.mark.parametrize("storage", ["list", "numpy"])
+def test_resizing_back_keeps_the_crop(tmp_path, monkeypatch, storage):
+    if storage == "numpy":
+        pytest.importorskip("numpy")
+    monkeypatch.setattr(TileLayer, "storage", storage)
+    monkeypatch.setattr(TileLayer, "sparse_density", None)
+    filename = str(tmp_path / "level0")
+    write_level(filename, Map([TileLayer("blue", [[3] * 20 for _ in range(20)])], set()))
+    level = open_level(filename)
+    journal = LevelJournal(filename, level)
+    layer = level.layers[0]
+    use_fake_context(level, tmp_path)
+    draw(level)
+
+    layer.resize(10, 10)
+    layer.resize(20, 20)
+    assert layer[15][15] == 0
+    assert draw(level) == render(level.layers)
+    journal.save()
+    assert open_level(filename).layers[0][15][15] == 0
+
+def layer_for_storage(monkeypatch, storage, rows):
+    if storage == "numpy":
+        pytest.importorskip("numpy")
+        monkeypatch.setattr(TileLayer, "storage", "numpy")
+    if storage == "sparse":
+        # Cells left out of a sparse layer are only skipped if tile 0 is empty
+        monkeypatch.setattr(FakeContext, "TILES", " ~###~#~")
+    else:
+        monkeypatch.setattr(TileLayer, "sparse_density", None)
+    layer = TileLayer("blue", rows)
+    assert layer._is_sparse() == (storage == "sparse") and layer._is_array() == (storage == "numpy")
+    return layer
+
+@pytest.mark.parametrize("storage", ["list", "numpy", "sparse"])
+def test_cached_chunks_match_an_uncached_render(tmp_path, monkeypatch, storage):
+    monkeypatch.setattr(TileLayer, "BULK_CELLS", 64)
+    if storage == "sparse":
+        rows = [[0] * 40 for _ in range(36)]
+        for i in range(30):
+            rows[i][i] = i % 8
+    else:
+        rows = [[(x * 3 + y) % 8 for x in range(40)] for y in range(36)]
+    level = Map([layer_for_storage(monkeypatch, storage, rows)], set())
+    layer = level.layers[0]
+    use_fake_context(level, tmp_path)
+    assert draw(level) == render(level.layers)
+
+    edits = [
+        lambda: layer.set_cell(3, 4, 5),
+        # See-through over what was drawn there just before
+        lambda: layer.set_cell(3, 4, 1),
+        lambda: layer.set_cell(39, 35, 7),
+        lambda: layer.stamp(14, 14, [[1, 5], [7, 3]], 4, 3),
+        lambda: layer.fill_region(30, 2, 3, 3, 1),
+        # Past BULK_CELLS
+        lambda: layer.fill_region(10, 10, 20, 10, 6),
+        lambda: layer.remap({1: 5, 6: 7, 0: 0}),
+        lambda: layer.resize(33, 20),
+        lambda: layer.resize(45, 40, 3),
+    ]
+    for edit in edits:
+        edit()
+        assert draw(level) == render(level.layers)
+    # Several edits between draws
+    layer.set_cell(0, 0, 4)
+    layer.stamp(40, 38, [[5]], 10, 10)
+    layer.set_cell(0, 0, 7)
+    assert draw(level) == render(level.layers)
+
+def test_composites_match_an_uncached_render(tmp_path, monkeypatch):
+    monkeypatch.setattr(TileLayer, "BULK_CELLS", 64)
+    monkeypatch.setattr(TileLayer, "sparse_density", None)
+    # The bottom layer is opaque but for one chunk with see-through and empty
+    # tiles, and smaller than the one above it
+    bottom = [[(0, 3, 4, 6)[(x + y) % 4] for x in range(40)] for y in range(36)]
+    bottom[20][20], bottom[21][22] = 1, 2
+    layers = [
+        TileLayer("blue", bottom),
+        TileLayer("blue", [[(2, 2, 1, 5, 2, 7)[(x * y) % 6] for x in range(48)] for y in range(40)]),
+        TileLayer("blue", [[(2, 5, 2)[(x + 2 * y) % 3] for x in range(40)] for y in range(36)]),
+        TileLayer("blue", [[(2, 1)[x % 5 == 0] for x in range(40)] for y in range(36)]),
+    ]
+    level = Map(layers, set())
+    use_fake_context(level, tmp_path)
+    assert draw(level) == render(level.layers)
+    assert any(key[0] is level._composite_key for key in list(surface_cache._images))
+
+    edits = [
+        # Above an opaque chunk, so in its composite
+        lambda: layers[1].set_cell(2, 3, 6),
+        lambda: layers[3].set_cell(5, 5, 7),
+        # Makes a composited chunk see-through, then opaque again
+        lambda: layers[0].set_cell(4, 4, 5),
+        lambda: layers[0].set_cell(4, 4, 0),
+        lambda: layers[0].fill_region(16, 16, 16, 16, 3),
+        lambda: layers[1].fill_region(0, 0, 20, 20, 1),
+        lambda: layers[2].stamp(10, 30, [[7, 2]], 20, 4),
+        lambda: [layer.remap({5: 1, 3: 4}) for layer in layers],
+        lambda: layers[0].resize(44, 40, 6),
+        lambda: layers[2].resize(20, 20),
+    ]
+    for edit in edits:
+        edit()
+        assert draw(level) == render(level.layers)
+
+@pytest.mark.parametrize("storage", ["list", "numpy", "sparse"])
+def test_animated_tiles_match_an_uncached_render(tmp_path, monkeypatch, storage):
+    monkeypatch.setattr(TileLayer, "BULK_CELLS", 64)
+    if storage == "sparse":
+        bottom = [[0] * 40 for _ in range(36)]
+        top = [[0] * 40 for _ in range(36)]
+        for i in range(30):
+            bottom[i][i] = (1, 3, 6)[i % 3]
+            top[i][39 - i] = (1, 5)[i % 2]
+    else:
+        bottom = [[(0, 3, 1, 6)[(x + y) % 4] for x in range(40)] for y in range(36)]
+        top = [[(2, 2, 1, 5, 2)[(x * y) % 5] for x in range(40)] for y in range(36)]
+    layers = [layer_for_storage(monkeypatch, storage, bottom), layer_for_storage(monkeypatch, storage, top)]
+    level = Map(layers, set())
+    tileset = use_fake_context(level, tmp_path)
+    tileset.add_animation(1, [1, 5, 7], 0.5)
+    tileset.add_animation(3, [3, 4], 1.0)
+    assert draw(level) == render(layers)
+
+    t = 0.0
+    steps = [
+        None,
+        lambda: layers[0].set_cell(2, 2, 1),
+        lambda: layers[1].stamp(14, 14, [[3, 1]], 6, 4),
+        lambda: layers[0].fill_region(0, 16, 20, 10, 3),
+        lambda: layers[1].remap({1: 6}),
+        lambda: tileset.add_animation(6, [6, 0], 0.25),
+        lambda: tileset.remove_animation(3),
+        lambda: layers[0].resize(30, 30),
+    ]
+    if storage == "sparse":
+        # Cells a sparse layer leaves out aren't empty for some frames
+        steps.append(lambda: tileset.add_animation(0, [0, 1], 0.5))
+    for step in steps:
+        if step is not None:
+            step()
+        for _ in range(3):
+            t += 0.3
+            level.animate(t)
+            assert draw(level) == render(layers, t)
@@ -0,0 +1,64 @@
+import os
+import shutil
+import pytest
+import leveltool
+from conftest import ROOT
+from game_types import ChunkedLevel, LevelJournal, open_level
+
+LEVELS = ["level0", "level1", "level2"]
+
+def copy_levels(directory):
+    for name in LEVELS:
+        shutil.copy(os.path.join(ROOT, name), str(directory))
+
+def test_validate_with_paths_after_options(tmp_path, capsys):
+    copy_levels(tmp_path)
+    assert leveltool.main(["validate", "-j", "2", str(tmp_path)]) == 0
+    assert "3 levels, 0 failed" in capsys.readouterr().out
+
+def test_reencode_compressed_in_place(tmp_path):
+    copy_levels(tmp_path)
+    assert leveltool.main(["reencode", "--compress", "zlib", str(tmp_path)]) == 0
+    assert leveltool.main(["validate", str(tmp_path)]) == 0
+
+def test_chunked_needs_out(tmp_path):
+    copy_levels(tmp_path)
+    with open(str(tmp_path / "level0"), "rb") as f:
+        before = f.read()
+    with pytest.raises(SystemExit):
+        leveltool.main(["reencode", "--chunked", str(tmp_path)])
+    with open(str(tmp_path / "level0"), "rb") as f:
+        assert f.read() == before
+
+def test_reencode_chunked_to_out(tmp_path):
+    copy_levels(tmp_path)
+    out = tmp_path / "chunked"
+    assert leveltool.main(["reencode", "--chunked", "--out", str(out), str(tmp_path)]) == 0
+    assert sorted(os.listdir(str(out))) == LEVELS
+    level = ChunkedLevel(str(out / "level0"))
+    try:
+        assert leveltool.same_map(level.load(), open_level(str(tmp_path / "level0")))
+    finally:
+        level.close()
+
+def test_reencode_to_out_leaves_the_journal_alone(tmp_path):
+    copy_levels(tmp_path)
+    filename = str(tmp_path / "level0")
+    level = open_level(filename)
+    level.layers[0].set_cell(0, 0, level.layers[0][0][0] + 1)
+    journal = LevelJournal(filename, level)
+    journal.save()
+    before = {}
+    for name in os.listdir(str(tmp_path)):
+        with open(str(tmp_path / name), "rb") as f:
+            before[name] = f.read()
+
+    out = tmp_path / "out"
+    assert leveltool.main(["reencode", "--out", str(out), str(tmp_path)]) == 0
+    after = {}
+    for name in os.listdir(str(tmp_path)):
+        if name != "out":
+            with open(str(tmp_path / name), "rb") as f:
+                after[name] = f.read()
+    assert after == before
+    assert leveltool.same_map(open_level(str(out / "level0")), level)
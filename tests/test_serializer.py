@@ -0,0 +1,113 @@
+import io
+import re
+import array
+import pytest
+import serializer
+from serializer import *
+
+# Bytes written before the serializer was rewritten for speed, which had to
+# keep the format as it was
+GOLDEN = [
+    (0, b"I\x00"),
+    (127, b"I\x7f"),
+    (128, b"I\x80\x01"),
+    (300, b"I\xac\x02"),
+    (1 << 40, b"I\x80\x80\x80\x80\x80 "),
+    (-1, b"i\xff\xff\xff\xff"),
+    (-300, b"i\xd4\xfe\xff\xff"),
+    ("", b"sI\x00"),
+    ("tile", b"sI\x04tile"),
+    ("\u017c\xf3\u0142w", b"sI\x07\xc5\xbc\xc3\xb3\xc5\x82w"),
+    ((1, "a"), b"TI\x02I\x01sI\x01a"),
+    ([1, [2, 3]], b"LI\x02I\x01LI\x02I\x02I\x03"),
+    ({"x": 1, "y": (2,)}, b"DI\x02sI\x01xI\x01sI\x01yTI\x01I\x02"),
+    ({1, 2, 3}, b"SI\x03I\x01I\x02I\x03"),
+    (None, b"N"),
+    (True, b"t"),
+    (False, b"F"),
+    (1.5, b"f\x00\x00\xc0?"),
+    (b"\x00\xff", b"bI\x02\x00\xff"),
+]
+
+ENTITY_GOLDEN = (b"OsI\x06EntityDI\x03sI\x04namesI\x04signsI\x0bscript_namesI\x07picturesI\nattributes"
+                 b"DI\x02sI\x01xI@sI\x04textsI\x02hi")
+# The same with interned strings: the string table, then "r" references
+ENTITY_INTERNED_GOLDEN = (b"RLI\tsI\x06EntitysI\x04namesI\x04signsI\x0bscript_namesI\x07picturesI\nattributes"
+                          b"sI\x01xsI\x04textsI\x02hiOr\x00DI\x03r\x01r\x02r\x03r\x04r\x05DI\x02r\x06I@r\x07r\x08")
+
+def encodings(value, intern=False):
+    f = io.BytesIO()
+    serialize_to(value, f, intern=intern)
+    return serialize(value, intern=intern), f.getvalue()
+
+@pytest.mark.parametrize("value, data", GOLDEN)
+def test_encoding_is_unchanged(value, data):
+    assert encodings(value) == (data, data)
+    assert deserialize(memoryview(data), 0) == (value, len(data))
+    assert deserialize_from(io.BytesIO(data)) == value
+
+def test_entity_encoding_is_unchanged():
+    from game_types import Entity
+    entity = Entity("sign", {"x": 64, "text": "hi"}, "picture", None)
+    assert encodings(entity) == (ENTITY_GOLDEN, ENTITY_GOLDEN)
+    assert encodings(entity, intern=True) == (ENTITY_INTERNED_GOLDEN, ENTITY_INTERNED_GOLDEN)
+    for data in (ENTITY_GOLDEN, ENTITY_INTERNED_GOLDEN):
+        decoded = deserialize(memoryview(data), 0)[0]
+        assert (decoded.name, decoded.script_name, decoded.attributes) == ("sign", "picture", {"x": 64, "text": "hi"})
+
+def test_blobs_decode_as_bytes():
+    data = serialize({"key": b"\x00\x01\x02", "more": [b"x"]})
+    for buf in (data, memoryview(data)):
+        value, offs = deserialize(buf, 0)
+        assert value == {"key": b"\x00\x01\x02", "more": [b"x"]}
+        assert type(value["key"]) is bytes and type(value["more"][0]) is bytes
+        assert offs == len(data)
+
+def test_blob_views():
+    data = memoryview(serialize(b"abc") + b"rest")
+    blob, offs = deserialize_blob(data, 0)
+    assert type(blob) is memoryview and bytes(blob) == b"abc"
+    assert bytes(data[offs:]) == b"rest"
+
+def test_entities_round_trip_interned_and_streamed():
+    from game_types import Entity
+    entities = [Entity("entity%d" % i, {"x": i, "kind": "tree"}, "picture", None) for i in range(3)]
+    for intern in (False, True):
+        f = io.BytesIO()
+        serialize_to(entities, f, intern=intern)
+        f.seek(0)
+        data = serialize(entities, intern=intern)
+        for decoded in (deserialize(memoryview(data), 0)[0], deserialize_from(f)):
+            assert [(e.name, e.attributes, e.script_name) for e in decoded] == \
+                   [(e.name, e.attributes, e.script_name) for e in entities]
+
+VARINTS = [0, 1, 0x7f, 0x80, 300, 0x3fff, 0x4000, 5, 6, 1 << 31, (1 << 32) - 1, 1 << 32, 1 << 40, 7,
+           (1 << 63) - 1, 1 << 63, (1 << 64) - 1, 0, 0x7f]
+
+@pytest.mark.parametrize("path", ["numpy", "python"])
+def test_unpack_varints_paths_agree(monkeypatch, path):
+    if path == "numpy":
+        if serializer.numpy is None:
+            pytest.skip("NumPy isn't installed")
+    else:
+        monkeypatch.setattr(serializer, "numpy", None)
+    # Untagged, the way old levels stored their tiles
+    data = b"xx" + b"".join(serialize(i)[1:] for i in VARINTS) + b"trailing"
+    for buf in (data, memoryview(data)):
+        values, offs = unpack_varints(buf, 2, len(VARINTS))
+        assert list(values) == VARINTS and data[offs:] == b"trailing"
+        values, offs = unpack_varints(buf, 2, 4)
+        assert list(values) == VARINTS[:4] and offs == 2 + len(b"".join(serialize(i)[1:] for i in VARINTS[:4]))
+        assert unpack_varints(buf, 2, 0) == (array.array(values.typecode), 2)
+    with pytest.raises(IndexError):
+        unpack_varints(data[:8], 2, len(VARINTS))
+
+@pytest.mark.parametrize("path", ["runs", "generic"])
+def test_sequence_decoding_paths_agree(monkeypatch, path):
+    if path == "generic":
+        monkeypatch.setattr(serializer, "_SMALL_INTS", re.compile(b"(?!)"))
+    value = [1, 2, 0x7f, 0x80, 3, -1, 1 << 40, "I", 4, 5, [6, 1 << 33], (7, 8), 0, 0x7f]
+    for result in (value, tuple(value), {1, 2, 0x80, 1 << 40}):
+        data = serialize(result)
+        assert deserialize(memoryview(data + b"I\x01"), 0) == (result, len(data))
+        assert deserialize_from(io.BytesIO(data)) == result